@@ -0,0 +1,72 @@
+import threading
+
+# Stages of an image in the order it goes through them
+COMPRESSED = "compressed"
+UPLOADED = "uploaded"
+ANALYZED = "analyzed"
+
+
+class ProgressTracker:
+    """
+    Counts how far the images of an analysis run got and reports every step.
+
+    An image counts as compressed once its preprocessed bytes are back, as uploaded
+    once all its parts are ready to be sent (inline or through the Files API) and as
+    analyzed once its verdict is known. Images answered from the job journal, the
+    result cache or the person pre-filter go straight to analyzed. Every step is
+    passed to ``on_progress`` as an event::
+
+        {"stage": "analyzed", "image_id": "camera_1_image_3.jpg", "result": {...},
+         "total": 40, "compressed": 12, "uploaded": 8, "analyzed": 5}
+
+    ``result`` is only set for analyzed events. Safe to use from several threads;
+    ``on_progress`` is called from the thread that made the step.
+
+    Args:
+        total (int): Number of images in the run
+        on_progress (callable, optional): Called with every event
+    """
+
+    def __init__(self, total, on_progress=None):
+        self.total = total
+        self.on_progress = on_progress
+        self._done = {COMPRESSED: set(), UPLOADED: set(), ANALYZED: set()}
+        self._lock = threading.Lock()
+
+    def _step(self, stage, image_ids, result=None):
+        events = []
+        with self._lock:
+            for image_id in image_ids:
+                if image_id in self._done[stage]:
+                    continue
+                self._done[stage].add(image_id)
+                event = {"stage": stage, "image_id": image_id, "total": self.total}
+                event.update({name: len(done) for name, done in self._done.items()})
+                if result is not None:
+                    event["result"] = result
+                events.append(event)
+        if self.on_progress is not None:
+            for event in events:
+                self.on_progress(event)
+
+    def compressed(self, *image_ids):
+        """Record that images were compressed."""
+        self._step(COMPRESSED, image_ids)
+
+    def uploaded(self, *image_ids):
+        """Record that all parts of images are ready to be sent."""
+        self._step(UPLOADED, image_ids)
+
+    def analyzed(self, image_id, result):
+        """Record the verdict of an image. Only the first verdict of an image is reported."""
+        self._step(ANALYZED, [image_id], result)
+
+    def counts(self):
+        """
+        Number of images per stage.
+
+        Returns:
+            dict: ``{"total", "compressed", "uploaded", "analyzed"}``
+        """
+        with self._lock:
+            return {"total": self.total, **{name: len(done) for name, done in self._done.items()}}
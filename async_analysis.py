@@ -0,0 +1,448 @@
+import os
+import time
+import asyncio
+import logging
+import concurrent.futures
+
+import google.generativeai as genai
+import google.generativeai.client as genai_client
+
+from metrics import METRICS
+from analysis_progress import ProgressTracker
+from objectdetection import (
+    ANALYSIS_PROMPT,
+    BATCH_SIZE,
+    FILE_REGISTRY,
+    GENERATE_TIMEOUT,
+    GENERATION_CONFIG,
+    HEDGE_POLICY,
+    INLINE_REQUEST_BUDGET,
+    MAX_CONCURRENT_BATCHES,
+    MODEL_NAME,
+    PREPROCESS_WORKERS,
+    RegionResults,
+    RATE_LIMITER,
+    RUN_TIMEOUT,
+    TOKENS_PER_IMAGE,
+    UPLOAD_TIMEOUT,
+    VerdictStreamParser,
+    cache_key,
+    chunk_text,
+    fits_inline,
+    labelled_parts,
+    list_image_paths,
+    make_preprocess_executor,
+    preprocessed_images,
+    preprocessing_job,
+    record_preprocessing,
+    split_into_batches,
+    unique_image_ids,
+    upload_bytes_to_gemini,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _uses_rest_transport():
+    # The SDK's async clients only work over gRPC: with transport="rest" they make
+    # the call synchronously and then fail to await the response
+    return genai_client._client_manager.client_config.get("transport") == "rest"
+
+
+async def generate_analysis_async(parts, on_result=None, deadline=None):
+    """
+    Ask Gemini to analyze a set of images without blocking the event loop.
+
+    Attempts are bounded by ``GENERATE_TIMEOUT`` and slow calls are hedged by
+    ``HEDGE_POLICY`` like in ``objectdetection.generate_analysis``; the slower
+    response of a hedged call is cancelled.
+
+    Args:
+        parts (list): ``(image_id, part)`` pairs, where part is an uploaded file
+            object or an inline image part
+        on_result (callable, optional): Called as ``on_result(image_id, result)`` as
+            soon as each verdict has been received
+        deadline (float, optional): ``time.monotonic()`` by which the call has to be
+            done; attempts are cut short and not retried past it
+
+    Returns:
+        dict: Analysis result per image id
+    """
+    image_ids = [image_id for image_id, _ in parts]
+    model = genai.GenerativeModel(model_name=MODEL_NAME, generation_config=GENERATION_CONFIG)
+    prompt = ANALYSIS_PROMPT.format(count=len(parts))
+    # Same turns as the chat session of the blocking path: the images, then the prompt
+    contents = [{"role": "user", "parts": labelled_parts(parts)}, {"role": "user", "parts": [prompt]}]
+    estimated_tokens = len(parts) * TOKENS_PER_IMAGE + len(prompt) // 4
+    results = {}
+
+    def emit(parser, timings, text):
+        parse_start = time.perf_counter()
+        completed = parser.feed(text)
+        timings["parse"] += time.perf_counter() - parse_start
+        for image_id, result in completed:
+            # A retry or a hedge starts a new stream, so verdicts that were already emitted are skipped
+            if image_id in results:
+                continue
+            if not results:
+                METRICS.observe("first_verdict", time.perf_counter() - timings["start"])
+            results[image_id] = result
+            if on_result is not None:
+                on_result(image_id, result)
+
+    async def stream(timeout):
+        parser = VerdictStreamParser(image_ids)
+        # Per stream, as a hedged duplicate may stream at the same time
+        timings = {"start": time.perf_counter(), "parse": 0.0}
+        request_options = {"timeout": timeout}
+        if _uses_rest_transport():
+            # Pull the blocking stream one chunk at a time from a worker thread
+            response = await asyncio.to_thread(
+                model.generate_content, contents, stream=True, request_options=request_options
+            )
+            chunks = iter(response)
+            while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+                emit(parser, timings, chunk_text(chunk))
+        else:
+            response = await model.generate_content_async(contents, stream=True, request_options=request_options)
+            async for chunk in response:
+                emit(parser, timings, chunk_text(chunk))
+        METRICS.observe("parse", timings["parse"])
+        return response
+
+    async def send():
+        timeout = GENERATE_TIMEOUT
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                raise TimeoutError("Run deadline passed before the Gemini request was sent")
+        with METRICS.timer("generate"):
+            return await asyncio.wait_for(stream(timeout), timeout)
+
+    response = await HEDGE_POLICY.call_async(
+        RATE_LIMITER.call_async, send, estimated_tokens=estimated_tokens, deadline=deadline
+    )
+
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None and usage.prompt_token_count:
+        RATE_LIMITER.tokens.adjust(estimated_tokens - usage.prompt_token_count)
+        METRICS.inc("prompt_tokens", usage.prompt_token_count)
+        METRICS.inc("output_tokens", usage.candidates_token_count)
+
+    logger.info("Gemini API analysis complete")
+    METRICS.inc("verdicts", len(results))
+    missing = [image_id for image_id in image_ids if image_id not in results]
+    if missing:
+        METRICS.inc("missing_verdicts", len(missing))
+        logger.warning(f"No verdict returned for {len(missing)} images: {', '.join(missing)}")
+    return results
+
+
+async def _analyze_batch_async(batch, executor, preprocess_executor, upload_slots, upload_mode, on_result,
+                               journal=None, deadline=None, progress=None, keys=None):
+    loop = asyncio.get_running_loop()
+    budget = INLINE_REQUEST_BUDGET
+
+    # Compression is CPU bound and runs in ``preprocess_executor``. Each image is sent
+    # inline or uploaded as soon as it is compressed; the SDK has no async file
+    # upload, so uploads run in ``executor``, bounded by ``upload_slots``.
+    async def send(part_id, data, mime_type):
+        nonlocal budget
+        if fits_inline(len(data), budget, upload_mode):
+            budget -= len(data)
+            METRICS.inc("inline_bytes", len(data))
+            return {"mime_type": mime_type, "data": data}
+        async with upload_slots:
+            timeout = UPLOAD_TIMEOUT if deadline is None else min(UPLOAD_TIMEOUT, deadline - time.monotonic())
+            try:
+                return await asyncio.wait_for(
+                    loop.run_in_executor(executor, upload_bytes_to_gemini, data, mime_type, part_id), max(0.0, timeout)
+                )
+            # asyncio.TimeoutError is only TimeoutError from Python 3.11 on
+            except asyncio.TimeoutError:
+                METRICS.inc("upload_timeouts")
+                logger.error(f"Upload of {part_id} did not finish in time, leaving it out of its request")
+                return None
+
+    # Images of cameras with regions of interest come back as several crops. The
+    # journal and the file registry are SQLite files, so they are used from ``executor``.
+    async def prepare(key, image_path):
+        resumed = None
+        if journal is not None:
+            resumed = await loop.run_in_executor(executor, journal.uploaded_parts, keys[key], FILE_REGISTRY)
+        if resumed:
+            METRICS.inc("uploads_resumed", len(resumed))
+            if progress is not None:
+                progress.uploaded(key)
+            return resumed
+        fn, args = preprocessing_job(image_path)
+        output = await loop.run_in_executor(preprocess_executor, fn, *args)
+        images = preprocessed_images(key, output)
+        for _, data, _, details in images:
+            record_preprocessing(image_path, data, details)
+        if journal is not None:
+            await loop.run_in_executor(
+                executor, journal.mark_compressed, keys[key], sum(len(data) for _, data, _, _ in images)
+            )
+        if progress is not None:
+            progress.compressed(key)
+        parts = await asyncio.gather(*(send(part_id, data, mime_type) for part_id, data, mime_type, _ in images))
+        parts = [(part_id, part) for (part_id, *_), part in zip(images, parts)]
+        if journal is not None and all(part and not isinstance(part, dict) for _, part in parts):
+            await loop.run_in_executor(executor, journal.mark_uploaded, keys[key], parts)
+        if progress is not None and all(part for _, part in parts):
+            progress.uploaded(key)
+        return parts
+
+    prepared = await asyncio.gather(*(prepare(key, image_path) for key, image_path in batch))
+    parts = [part for image_parts in prepared for part in image_parts]
+    uploaded = [(part_id, part) for part_id, part in parts if part]
+
+    if not uploaded:
+        logger.error(f"No files of a batch of {len(batch)} were successfully uploaded.")
+        return {}
+
+    results = RegionResults(parts, batch, on_result)
+    await generate_analysis_async(uploaded, results, deadline)
+    return results.results
+
+
+async def analyze_images_async(image_folder, max_images=None, cache=None, batch_size=BATCH_SIZE,
+                               max_concurrent_batches=MAX_CONCURRENT_BATCHES, max_concurrent_uploads=32,
+                               upload_mode="auto", executor=None, on_result=None, prefilter=None,
+                               preprocess_executor=None, journal=None, run_timeout=RUN_TIMEOUT, on_progress=None):
+    """
+    Asynchronous counterpart of ``objectdetection.analyze_all_images``.
+
+    Generate calls are awaited on the event loop, so thousands of requests can be in
+    flight from one thread; image compression runs in ``preprocess_executor`` and the
+    occasional Files API upload, which the SDK only offers synchronously, in
+    ``executor``. Can be awaited
+    from an existing event loop or run with ``analyze_images``.
+
+    Args:
+        image_folder (str): Folder containing images to analyze
+        max_images (int, optional): Maximum number of images to analyze. Defaults to all images.
+        cache (ResultCache, optional): Serve previously analyzed images from this cache
+            and store new results in it
+        batch_size (int, optional): Images per Gemini request
+        max_concurrent_batches (int, optional): Gemini requests in flight at once
+        max_concurrent_uploads (int, optional): Files API uploads in flight at once
+        upload_mode (str, optional): "auto" or "inline"; "files" uploads every image
+            from memory
+        executor (concurrent.futures.Executor, optional): Pool for uploads, hashing and
+            the pre-filter. Defaults to a thread pool of ``max_concurrent_uploads``
+            threads; a pool given here should be at least that large, or uploads
+            queued behind busy threads use up their ``UPLOAD_TIMEOUT`` before they start.
+        on_result (callable, optional): Called as ``on_result(file_name, result)`` for
+            every verdict as soon as it is available, including cache hits
+        prefilter (PersonPrefilter, optional): Answer images without a detected person
+            locally (in ``executor``) and only send the rest to Gemini
+        preprocess_executor (concurrent.futures.Executor, optional): Pool for image
+            compression. Defaults to a process pool of ``PREPROCESS_WORKERS`` processes,
+            see ``objectdetection.make_preprocess_executor``.
+        journal (JobJournal, optional): Checkpoint every image's progress and resume
+            from it, see ``objectdetection.analyze_image_paths``
+        run_timeout (float, optional): Seconds the run may take; batches still
+            running when it expires are cancelled and their images reported as
+            unfinished
+        on_progress (callable, optional): Called with an event every time an image
+            was compressed, uploaded or analyzed, see ``analysis_progress.ProgressTracker``
+
+    Returns:
+        dict: Analysis results keyed by image file name, in folder order
+    """
+    start_time = time.time()
+    deadline = time.monotonic() + run_timeout if run_timeout is not None else None
+    results = {}
+    loop = asyncio.get_running_loop()
+
+    image_paths = list_image_paths(image_folder, max_images)
+    if not image_paths:
+        logger.warning("No valid image files found in the specified folder.")
+        return results
+
+    logger.info(f"Found {len(image_paths)} images to analyze")
+    progress = ProgressTracker(len(image_paths), on_progress)
+
+    def deliver(key, result):
+        progress.analyzed(key, result)
+        if on_result is not None:
+            on_result(key, result)
+
+    own_executor = executor is None
+    if own_executor:
+        # One thread per upload slot, so an upload let through by ``upload_slots`` starts right away
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_uploads)
+    own_preprocess_executor = preprocess_executor is None
+    if own_preprocess_executor:
+        preprocess_executor = make_preprocess_executor(PREPROCESS_WORKERS)
+
+    try:
+        pending = list(zip(unique_image_ids(image_paths), image_paths))
+        # The result cache and the journal both know images by what was asked about them
+        keys = {}
+        if cache is not None or journal is not None:
+            hashes = await asyncio.gather(*(
+                loop.run_in_executor(executor, cache_key, image_path) for _, image_path in pending
+            ))
+            keys = {key: digest for (key, _), digest in zip(pending, hashes)}
+
+        # The journal and the cache are SQLite files: read and write them in
+        # ``executor``, so a slow disk does not hold up the requests in flight
+        async def lookup(get, candidates):
+            return await asyncio.gather(*(loop.run_in_executor(executor, get, keys[key]) for key, _ in candidates))
+
+        # Resume an interrupted run: images it analyzed are done
+        if journal is not None:
+            candidates, pending = pending, []
+            for (key, image_path), recorded in zip(candidates, await lookup(journal.result, candidates)):
+                if recorded is not None:
+                    results[key] = recorded
+                    deliver(key, recorded)
+                else:
+                    pending.append((key, image_path))
+            if len(pending) < len(candidates):
+                logger.info(
+                    f"Job journal: resuming with {len(candidates) - len(pending)} of {len(candidates)} images done"
+                )
+
+        # Serve cache hits and only send the misses to Gemini
+        if cache is not None and pending:
+            candidates, pending = pending, []
+            for (key, image_path), cached in zip(candidates, await lookup(cache.get, candidates)):
+                if cached is not None:
+                    results[key] = cached
+                    deliver(key, cached)
+                else:
+                    pending.append((key, image_path))
+            hits = len(candidates) - len(pending)
+            logger.info(
+                f"Result cache: {hits} hits, {len(pending)} misses "
+                f"({hits / len(candidates):.0%} hit rate)"
+            )
+
+        if prefilter is not None and pending:
+            checks = await asyncio.gather(*(
+                loop.run_in_executor(executor, prefilter.check_path, image_path) for _, image_path in pending
+            ))
+            candidates, pending = pending, []
+            for (key, image_path), has_person in zip(candidates, checks):
+                if has_person:
+                    pending.append((key, image_path))
+                    continue
+                results[key] = prefilter.skip_result()
+                deliver(key, results[key])
+            skipped = len(candidates) - len(pending)
+            logger.info(
+                f"Person pre-filter: {skipped} of {len(candidates)} images answered locally "
+                f"({skipped / len(candidates):.0%} skip ratio)"
+            )
+
+        batches = split_into_batches(pending, batch_size)
+        if batches:
+            logger.info(f"Analyzing {len(pending)} images in {len(batches)} batches of up to {batch_size}")
+
+        # Verdicts are kept as they stream in, so a run that times out still returns
+        # those of the batches it cancelled
+        streamed = {}
+
+        def report(key, result):
+            streamed[key] = result
+            deliver(key, result)
+
+        def record(store, batch_results):
+            for key, result in batch_results.items():
+                if result["answer"] != "unknown":
+                    store(keys[key], result)
+
+        batch_slots = asyncio.Semaphore(max_concurrent_batches)
+        upload_slots = asyncio.Semaphore(max_concurrent_uploads)
+
+        async def run_batch(batch):
+            submitted_at = time.perf_counter()
+            async with batch_slots:
+                METRICS.observe("batch_queue", time.perf_counter() - submitted_at)
+                batch_results = await _analyze_batch_async(
+                    batch, executor, preprocess_executor, upload_slots, upload_mode, report, journal, deadline,
+                    progress, keys
+                )
+            # Checkpoint each batch as it finishes
+            if journal is not None:
+                await loop.run_in_executor(executor, record, journal.mark_analyzed, batch_results)
+            return batch_results
+
+        tasks = [asyncio.ensure_future(run_batch(batch)) for batch in batches]
+        if tasks:
+            timeout = deadline - time.monotonic() if deadline is not None else None
+            done, unfinished = await asyncio.wait(tasks, timeout=max(0.0, timeout) if timeout is not None else None)
+            for task in unfinished:
+                task.cancel()
+            if unfinished:
+                METRICS.inc("run_timeouts")
+                await asyncio.gather(*unfinished, return_exceptions=True)
+                for key, result in streamed.items():
+                    results.setdefault(key, result)
+
+        for task in tasks:
+            if task.cancelled():
+                continue
+            if task.exception() is not None:
+                logger.error(f"Error during Gemini API call: {task.exception()}")
+                continue
+            batch_results = task.result()
+            results.update(batch_results)
+            if cache is not None:
+                await loop.run_in_executor(executor, record, cache.put, batch_results)
+
+        if deadline is not None and time.monotonic() >= deadline:
+            missing = [key for key, _ in pending if key not in results]
+            if missing:
+                logger.error(
+                    f"Run deadline of {run_timeout:.0f}s reached with {len(missing)} images unfinished: "
+                    f"{', '.join(missing[:20])}{' ...' if len(missing) > 20 else ''}"
+                )
+
+        if cache is not None:
+            await loop.run_in_executor(executor, cache.evict)
+        # Once every image has a verdict the run is over and its checkpoints can go
+        if journal is not None and all(
+            key in results and results[key]["answer"] != "unknown" for key in keys
+        ):
+            await loop.run_in_executor(executor, journal.finish)
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False)
+        if own_preprocess_executor:
+            preprocess_executor.shutdown(wait=False)
+
+    logger.info(f"Total time taken for image analysis: {time.time() - start_time:.2f} seconds")
+
+    # Report images in folder order regardless of which batch finished first
+    order = {key: i for i, key in enumerate(unique_image_ids(image_paths))}
+    return {key: results[key] for key in sorted(results, key=order.get)}
+
+
+def analyze_images(image_folder, **kwargs):
+    """
+    Run ``analyze_images_async`` to completion from synchronous code.
+
+    Args:
+        image_folder (str): Folder containing images to analyze
+        **kwargs: Passed on to ``analyze_images_async``
+
+    Returns:
+        dict: Analysis results for each image
+    """
+    return asyncio.run(analyze_images_async(image_folder, **kwargs))
+
+
+if __name__ == "__main__":
+    from job_journal import JobJournal
+    from result_cache import ResultCache
+
+    results = analyze_images(
+        "all_cameras_images", cache=ResultCache(), journal=JobJournal(run_id="all_cameras_images")
+    )
+    for image, data in results.items():
+        print(f"{image}: {data['answer']} - {data['explanation']}")
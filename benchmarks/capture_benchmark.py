@@ -0,0 +1,125 @@
+"""
+Compare CPU cost per camera of the read-everything capture loop against the
+grab/retrieve frame-skipping loop in downloadimages.FrameSampler.
+
+Usage:
+    python benchmarks/capture_benchmark.py
+    python benchmarks/capture_benchmark.py --source recording.mp4 --frame-interval 125
+    python benchmarks/capture_benchmark.py --sample-seconds 5
+
+Without --source a synthetic 1080p clip is generated in a temporary folder.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from downloadimages import FrameSampler
+
+
+def make_synthetic_video(path, frames=750, width=1920, height=1080, fps=25):
+    """
+    Write a synthetic clip with a moving block so the encoder produces real motion.
+
+    Args:
+        path (str): Output video path
+        frames (int): Number of frames to write
+        width (int): Frame width
+        height (int): Frame height
+        fps (int): Frames per second
+
+    Returns:
+        str: Path to the written video
+    """
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    background = np.random.default_rng(0).integers(0, 255, (height, width, 3), dtype=np.uint8)
+    for i in range(frames):
+        frame = background.copy()
+        x = (i * 16) % (width - 200)
+        cv2.rectangle(frame, (x, 200), (x + 200, 400), (0, 0, 255), -1)
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+def run_camera(source, sampler):
+    """Drain one source through a sampler and return the number of frames read."""
+    cap = cv2.VideoCapture(source)
+    try:
+        while True:
+            ret, _ = sampler.next_frame(cap)
+            if not ret:
+                break
+    finally:
+        cap.release()
+    return sampler.frame_count
+
+
+def run_mode(source, cameras, skip_decode, frame_interval, sample_seconds):
+    """
+    Run ``cameras`` concurrent captures of ``source`` and measure process CPU time.
+
+    Returns:
+        dict: Wall time, CPU time, frames read and frames kept for the run
+    """
+    samplers = [
+        FrameSampler(frame_interval, sample_seconds=sample_seconds, skip_decode=skip_decode, clock="stream")
+        for _ in range(cameras)
+    ]
+    threads = [threading.Thread(target=run_camera, args=(source, sampler)) for sampler in samplers]
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return {
+        "wall": time.perf_counter() - wall_start,
+        "cpu": time.process_time() - cpu_start,
+        "frames": sum(sampler.frame_count for sampler in samplers),
+        "kept": sum(sampler.kept_count for sampler in samplers),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", help="Video file or stream URL (default: synthetic 1080p clip)")
+    parser.add_argument("--cameras", type=int, default=1, help="Concurrent captures per mode")
+    parser.add_argument("--frame-interval", type=int, default=125)
+    parser.add_argument("--sample-seconds", type=float, default=None)
+    parser.add_argument("--frames", type=int, default=750, help="Length of the synthetic clip")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source = args.source or make_synthetic_video(os.path.join(temp_dir, "synthetic.mp4"), frames=args.frames)
+        fps = cv2.VideoCapture(source).get(cv2.CAP_PROP_FPS) or 25
+
+        print(f"Source: {source}  cameras: {args.cameras}")
+        baseline = None
+        for label, skip_decode in (("read every frame", False), ("grab + retrieve", True)):
+            stats = run_mode(source, args.cameras, skip_decode, args.frame_interval, args.sample_seconds)
+            cpu_per_camera = stats["cpu"] / args.cameras
+            stream_seconds = stats["frames"] / args.cameras / fps
+            line = (
+                f"{label:<18} cpu/camera: {cpu_per_camera:7.3f}s  "
+                f"cores/camera at real time: {cpu_per_camera / stream_seconds:6.3f}  "
+                f"frames: {stats['frames']}  kept: {stats['kept']}  wall: {stats['wall']:.2f}s"
+            )
+            if baseline is None:
+                baseline = cpu_per_camera
+            else:
+                line += f"  ({baseline / cpu_per_camera:.2f}x less CPU)"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Compare mosaic batching (several frames tiled into one image) with sending one
+image per frame: cost, latency and, against the real API, accuracy.
+
+For every mode the same images are analyzed once and the benchmark reports
+images/s, p50/p99 time from the start of the run until each verdict arrives,
+requests, bytes sent, prompt tokens and the share of verdicts that agree with the
+reference. The reference is --labels when given (a CSV of ``file_name,verdict``
+lines, verdict yes or no) and otherwise the one-image-per-frame verdicts.
+
+By default the pipeline runs against the local Gemini stand-in, which counts
+image tokens like Gemini 2.0 (258 per 768px tile) but answers "no" for every
+frame, so cost and latency are meaningful offline while accuracy only shows that
+every verdict was mapped back to its frame. Pass --live to run against the real
+API with GEMINI_API_KEY for the accuracy numbers.
+
+Usage:
+    python benchmarks/mosaic_benchmark.py
+    python benchmarks/mosaic_benchmark.py --tiles 4 9 16 --image-latency 0.05
+    python benchmarks/mosaic_benchmark.py --live --max-images 40 --labels labels.csv --output mosaic.jsonl
+"""
+import argparse
+import contextlib
+import csv
+import datetime
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import objectdetection
+from fake_gemini_server import FakeGeminiServer
+from file_registry import FileRegistry
+from metrics import METRICS
+from objectdetection import analyze_all_images
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of ``values`` (``q`` between 0 and 100)."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+
+def read_labels(path):
+    """
+    Read ground truth verdicts.
+
+    Returns:
+        dict: Verdict ("yes" or "no") per file name
+    """
+    with open(path, newline="") as f:
+        return {
+            row[0].strip(): row[1].strip().lower()
+            for row in csv.reader(f)
+            if len(row) >= 2 and row[1].strip().lower() in ("yes", "no")
+        }
+
+
+def agreement(results, reference):
+    """Share of the images in both ``results`` and ``reference`` with the same verdict."""
+    shared = [image for image in results if image in reference]
+    if not shared:
+        return float("nan")
+    return sum(results[image]["answer"] == reference[image] for image in shared) / len(shared)
+
+
+def run_mode(folder, tiles, args):
+    """
+    Analyze the images once, as mosaics of ``tiles`` frames or one image per frame.
+
+    Returns:
+        tuple: (measurements, results)
+    """
+    latencies = []
+    lock = threading.Lock()
+    METRICS.reset()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        # A fresh registry per run, so uploads from earlier runs are not reused
+        objectdetection.FILE_REGISTRY = FileRegistry(os.path.join(scratch, "files.sqlite3"))
+        start = time.perf_counter()
+
+        def on_result(image_id, result):
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+        results = analyze_all_images(folder, None, max_images=args.max_images, batch_size=args.batch_size,
+                                     on_result=on_result, mosaic=tiles)
+        wall = time.perf_counter() - start
+
+    snapshot = METRICS.snapshot()
+    counters = snapshot["counters"]
+    stages = snapshot["stages"]
+    return {
+        "mode": f"mosaic {tiles}" if tiles else "per frame",
+        "tiles": tiles or 1,
+        "verdicts": len(results),
+        "wall_seconds": wall,
+        "images_per_second": len(results) / wall if wall else 0.0,
+        "p50_seconds": percentile(latencies, 50),
+        "p99_seconds": percentile(latencies, 99),
+        "requests": sum(stages.get(stage, {}).get("count", 0) for stage in ("generate", "upload")),
+        "bytes_sent": counters.get("inline_bytes", 0) + counters.get("uploaded_bytes", 0),
+        "prompt_tokens": counters.get("prompt_tokens", 0),
+    }, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--folder", default=os.path.join(REPO_ROOT, "all_cameras_images"))
+    parser.add_argument("--max-images", type=int, default=40)
+    parser.add_argument("--tiles", type=int, nargs="+", default=[4, 9], help="Frames per mosaic to compare")
+    parser.add_argument("--batch-size", type=int, default=objectdetection.BATCH_SIZE)
+    parser.add_argument("--labels", help="CSV of file_name,verdict to measure accuracy against")
+    parser.add_argument("--live", action="store_true", help="Use the real Gemini API instead of the stand-in")
+    parser.add_argument("--latency", type=float, default=0.05, help="Stand-in: seconds added to every request")
+    parser.add_argument("--image-latency", type=float, default=0.02,
+                        help="Stand-in: seconds added to a generate request per image")
+    parser.add_argument("--output", help="Append results to this JSON lines file")
+    args = parser.parse_args()
+
+    # Keep per-image log lines out of the report
+    logging.getLogger().setLevel(logging.ERROR)
+
+    labels = read_labels(args.labels) if args.labels else None
+    server = contextlib.nullcontext() if args.live else FakeGeminiServer(
+        latency=args.latency, image_latency=args.image_latency
+    )
+    with server:
+        if not args.live:
+            server.configure_genai()
+        print(f"{'mode':>10} {'images':>7} {'wall s':>7} {'img/s':>7} {'p50 s':>6} {'p99 s':>6} "
+              f"{'requests':>9} {'MB sent':>8} {'tokens':>8} {'agree':>6}")
+        reference = labels
+        for tiles in [None] + args.tiles:
+            result, verdicts = run_mode(args.folder, tiles, args)
+            if reference is None:
+                reference = {image: data["answer"] for image, data in verdicts.items()}
+            result["agreement"] = agreement(verdicts, reference)
+            print(
+                f"{result['mode']:>10} {result['verdicts']:>7d} {result['wall_seconds']:>7.2f} "
+                f"{result['images_per_second']:>7.1f} {result['p50_seconds']:>6.2f} {result['p99_seconds']:>6.2f} "
+                f"{result['requests']:>9d} {result['bytes_sent'] / 1e6:>8.2f} {result['prompt_tokens']:>8d} "
+                f"{result['agreement']:>6.0%}"
+            )
+            if args.output:
+                record = dict(result, live=args.live, reference="labels" if labels else "per frame",
+                              timestamp=datetime.datetime.now().isoformat(timespec="seconds"))
+                with open(args.output, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
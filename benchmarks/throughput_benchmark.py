@@ -0,0 +1,223 @@
+"""
+End-to-end throughput of the analysis pipeline against a local Gemini stand-in
+server, so performance can be tracked offline and without an API key.
+
+For every size the pipeline analyzes that many camera-style fixture images and
+reports images per second, p50/p99 time from the start of the run until each
+image's verdict arrives, requests made, bytes sent to the server and the errors
+and 429s the server injected. The JSON lines output also carries the per-stage
+histograms of metrics.METRICS. The individual stages compress_image and
+upload_image are timed once up front.
+
+Usage:
+    python benchmarks/throughput_benchmark.py
+    python benchmarks/throughput_benchmark.py --sizes 10 100 --latency 0.2 --image-latency 0.05
+    python benchmarks/throughput_benchmark.py --error-rate 0.02 --server-rpm 300 --output results.jsonl
+    python benchmarks/throughput_benchmark.py --engine async --fixtures /tmp/fixtures
+
+Fixtures are generated from the images in --source (all_cameras_images by
+default): each one is a source image scaled to --width x --height with its index
+stamped on it, so no two fixtures share content and nothing is served from a
+cache. Pass --fixtures to keep them between runs. With --output every result is
+appended as a JSON line.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import objectdetection
+from async_analysis import analyze_images
+from fake_gemini_server import FakeGeminiServer
+from file_registry import FileRegistry
+from metrics import METRICS
+from objectdetection import analyze_all_images, compress_image, list_image_paths, upload_image
+from rate_limiter import TokenBucket
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_fixtures(folder, count, source_folder, width=1920, height=1080):
+    """
+    Fill ``folder`` with ``count`` unique camera-style JPEGs, reusing existing ones.
+
+    Args:
+        folder (str): Output folder
+        count (int): Number of fixtures needed
+        source_folder (str): Folder with the images the fixtures are made from
+        width (int): Fixture width
+        height (int): Fixture height
+
+    Returns:
+        str: ``folder``
+    """
+    os.makedirs(folder, exist_ok=True)
+    sources = sorted(list_image_paths(source_folder))
+    if not sources:
+        raise SystemExit(f"No source images in {source_folder}")
+
+    frames = {}
+    for i in range(count):
+        path = os.path.join(folder, f"fixture_{i:06d}.jpg")
+        if os.path.exists(path):
+            continue
+        source = sources[i % len(sources)]
+        if source not in frames:
+            frames[source] = cv2.resize(cv2.imread(source), (width, height), interpolation=cv2.INTER_AREA)
+        frame = frames[source].copy()
+        cv2.putText(frame, f"{i:06d}", (20, height - 20), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (255, 255, 255), 3)
+        cv2.imwrite(path, frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return folder
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of ``values`` (``q`` between 0 and 100)."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+
+def time_stages(server, image_paths):
+    """
+    Time compress_image and upload_image one image at a time.
+
+    Returns:
+        dict: Mean milliseconds per image of each stage
+    """
+    with tempfile.TemporaryDirectory() as compress_folder:
+        objectdetection.FILE_REGISTRY = FileRegistry(os.path.join(compress_folder, "files.sqlite3"))
+        start = time.perf_counter()
+        for image_path in image_paths:
+            os.remove(compress_image(image_path, compress_folder))
+        compress_ms = (time.perf_counter() - start) * 1000 / len(image_paths)
+
+        start = time.perf_counter()
+        for image_path in image_paths:
+            upload_image(image_path, compress_folder)
+        upload_ms = (time.perf_counter() - start) * 1000 / len(image_paths)
+    server.reset_stats()
+    return {"compress_image_ms": compress_ms, "upload_image_ms": upload_ms}
+
+
+def run_size(server, folder, size, args):
+    """
+    Analyze the first ``size`` fixtures once and measure it.
+
+    Returns:
+        dict: Throughput, latency percentiles and server counters of the run
+    """
+    latencies = []
+    lock = threading.Lock()
+    server.reset_stats()
+    METRICS.reset()
+
+    with tempfile.TemporaryDirectory() as compress_folder:
+        # A fresh registry per run, so uploads from earlier runs are not reused
+        objectdetection.FILE_REGISTRY = FileRegistry(os.path.join(compress_folder, "files.sqlite3"))
+        start = time.perf_counter()
+
+        def on_result(image_id, result):
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+        options = {"max_images": size, "batch_size": args.batch_size, "upload_mode": args.upload_mode,
+                   "max_concurrent_batches": args.concurrent_batches, "on_result": on_result}
+        if args.engine == "async":
+            results = analyze_images(folder, **options)
+        else:
+            results = analyze_all_images(folder, compress_folder, **options)
+        wall = time.perf_counter() - start
+
+    stats = server.stats()
+    return {
+        "size": size,
+        "verdicts": len(results),
+        "wall_seconds": wall,
+        "images_per_second": len(results) / wall if wall else 0.0,
+        "p50_seconds": percentile(latencies, 50),
+        "p99_seconds": percentile(latencies, 99),
+        "requests": stats["requests"],
+        "bytes_sent": stats["bytes_received"],
+        "errors": stats["errors"],
+        "throttled": stats["throttled"],
+        "stages": {
+            stage: {key: data[key] for key in ("count", "sum", "p50", "p99")}
+            for stage, data in METRICS.snapshot()["stages"].items()
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 10000], help="Images per run")
+    parser.add_argument("--source", default=os.path.join(REPO_ROOT, "all_cameras_images"))
+    parser.add_argument("--fixtures", help="Folder for the generated fixtures (default: temporary)")
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--engine", choices=("threads", "async"), default="threads")
+    parser.add_argument("--upload-mode", choices=("auto", "inline", "files"), default="auto")
+    parser.add_argument("--batch-size", type=int, default=objectdetection.BATCH_SIZE)
+    parser.add_argument("--concurrent-batches", type=int, default=objectdetection.MAX_CONCURRENT_BATCHES)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds added to every request")
+    parser.add_argument("--image-latency", type=float, default=0.0,
+                        help="Seconds added to a generate request per image")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests failing with 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests failing with 429")
+    parser.add_argument("--server-rpm", type=float, help="Request quota of the server, 429 above it")
+    parser.add_argument("--rpm", type=float, help="Override REQUESTS_PER_MINUTE of the client rate limiter")
+    parser.add_argument("--tpm", type=float, help="Override TOKENS_PER_MINUTE of the client rate limiter")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Append results to this JSON lines file")
+    args = parser.parse_args()
+
+    # Keep per-image log lines out of the report
+    logging.getLogger().setLevel(logging.ERROR)
+
+    if args.rpm:
+        objectdetection.RATE_LIMITER.requests = TokenBucket(args.rpm)
+    if args.tpm:
+        objectdetection.RATE_LIMITER.tokens = TokenBucket(args.tpm)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        folder = args.fixtures or os.path.join(scratch, "fixtures")
+        print(f"Preparing {max(args.sizes)} fixtures of {args.width}x{args.height} in {folder}")
+        make_fixtures(folder, max(args.sizes), args.source, args.width, args.height)
+
+        with FakeGeminiServer(latency=args.latency, image_latency=args.image_latency, error_rate=args.error_rate,
+                              throttle_rate=args.throttle_rate, requests_per_minute=args.server_rpm,
+                              seed=args.seed) as server:
+            server.configure_genai()
+            stages = time_stages(server, list_image_paths(folder, min(10, max(args.sizes))))
+            print(
+                f"engine: {args.engine}  upload mode: {args.upload_mode}  latency: {args.latency * 1000:.0f} ms  "
+                f"compress_image: {stages['compress_image_ms']:.1f} ms/img  "
+                f"upload_image: {stages['upload_image_ms']:.1f} ms/img"
+            )
+            print(f"{'images':>7} {'wall s':>8} {'img/s':>8} {'p50 s':>7} {'p99 s':>7} "
+                  f"{'requests':>9} {'MB sent':>8} {'errors':>7} {'429s':>6}")
+            for size in args.sizes:
+                result = run_size(server, folder, size, args)
+                print(
+                    f"{result['verdicts']:>7d} {result['wall_seconds']:>8.2f} {result['images_per_second']:>8.1f} "
+                    f"{result['p50_seconds']:>7.2f} {result['p99_seconds']:>7.2f} {result['requests']:>9d} "
+                    f"{result['bytes_sent'] / 1e6:>8.2f} {result['errors']:>7d} {result['throttled']:>6d}"
+                )
+                if args.output:
+                    record = dict(result, **stages, **{k: v for k, v in vars(args).items() if k != "output"},
+                                  timestamp=datetime.datetime.now().isoformat(timespec="seconds"))
+                    with open(args.output, "a") as f:
+                        f.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Compare the Files API upload path of analyze_all_images with the in-memory
+inline path against a local Gemini stand-in server.
+
+Usage:
+    python benchmarks/upload_benchmark.py
+    python benchmarks/upload_benchmark.py --folder all_cameras_images --latency 0.08
+
+--latency adds a fixed delay to every request the stand-in serves, to model the
+network round trip to the real API.
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import objectdetection
+from fake_gemini_server import FakeGeminiServer
+from file_registry import FileRegistry
+from objectdetection import analyze_all_images
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_mode(server, folder, upload_mode, batch_size):
+    """
+    Analyze ``folder`` once with ``upload_mode`` and measure it.
+
+    Returns:
+        dict: Wall time, verdict count, request count and bytes sent to the server
+    """
+    requests_before = sum(server.requests.values())
+    bytes_before = server.bytes_received
+    with tempfile.TemporaryDirectory() as compress_folder:
+        # A fresh registry per run, so uploads from earlier runs are not reused
+        objectdetection.FILE_REGISTRY = FileRegistry(os.path.join(compress_folder, "files.sqlite3"))
+        start = time.perf_counter()
+        results = analyze_all_images(folder, compress_folder, batch_size=batch_size, upload_mode=upload_mode)
+        wall = time.perf_counter() - start
+    return {
+        "wall": wall,
+        "results": len(results),
+        "requests": sum(server.requests.values()) - requests_before,
+        "bytes": server.bytes_received - bytes_before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--folder", default=os.path.join(REPO_ROOT, "all_cameras_images"))
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds added to every request")
+    parser.add_argument("--batch-size", type=int, default=20)
+    args = parser.parse_args()
+
+    # Keep per-image log lines out of the report
+    logging.getLogger().setLevel(logging.ERROR)
+
+    with FakeGeminiServer(latency=args.latency) as server:
+        server.configure_genai()
+        print(f"Folder: {args.folder}  latency per request: {args.latency * 1000:.0f} ms")
+        baseline = None
+        for upload_mode in ("files", "auto"):
+            stats = run_mode(server, args.folder, upload_mode, args.batch_size)
+            line = (
+                f"{upload_mode:<6} wall: {stats['wall']:6.2f}s  verdicts: {stats['results']:4d}  "
+                f"requests: {stats['requests']:5d}  bytes sent: {stats['bytes'] / 1e6:7.2f} MB"
+            )
+            if baseline is None:
+                baseline = stats["wall"]
+            else:
+                line += f"  ({baseline / stats['wall']:.2f}x faster)"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
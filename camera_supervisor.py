@@ -0,0 +1,322 @@
+import cv2
+import os
+import time
+import queue
+import random
+import threading
+import multiprocessing
+
+from downloadimages import FrameNamer, FrameSampler, RTSP_URLS, camera_id_from_url
+from scene_change import SceneChangeGate
+
+# Camera states reported by the workers
+CONNECTING = "connecting"
+STREAMING = "streaming"
+BACKOFF = "backoff"
+STOPPED = "stopped"
+
+
+def backoff_delay(attempt, base=1.0, maximum=60.0):
+    """
+    Exponential backoff with full jitter.
+
+    Args:
+        attempt (int): Number of consecutive failures so far (0 for the first retry)
+        base (float): Delay of the first retry in seconds
+        maximum (float): Upper bound of the delay in seconds
+
+    Returns:
+        float: Seconds to wait before reconnecting
+    """
+    return random.uniform(0, min(maximum, base * (2 ** attempt)))
+
+
+def _camera_loop(rtsp_url, save_directory, sampler_options, decoder_slots, status_queue, stop_event,
+                 backoff_base, backoff_max, report_interval, scene_gate=None):
+    """
+    Capture one camera until ``stop_event`` is set, reconnecting whenever the stream drops.
+
+    Runs on a thread inside a worker process. Every retrieve (decode) holds one of the
+    worker's ``decoder_slots``; grabbing, which waits on the network, does not, so a
+    stalled stream never keeps another camera from decoding.
+    """
+    camera_id = camera_id_from_url(rtsp_url)
+    namer = FrameNamer(save_directory, camera_id)
+    stats = {
+        "camera_id": camera_id,
+        "state": CONNECTING,
+        "pid": os.getpid(),
+        "frames_read": 0,
+        "images_saved": 0,
+        "images_suppressed": 0,
+        "reconnects": 0,
+        "last_frame_at": None,
+        "last_error": None,
+    }
+
+    def report(**changes):
+        stats.update(changes, updated_at=time.time())
+        status_queue.put((rtsp_url, dict(stats)))
+
+    attempt = 0
+    while not stop_event.is_set():
+        report(state=CONNECTING)
+        cap = cv2.VideoCapture(rtsp_url)
+        try:
+            if not cap.isOpened():
+                error = "Could not open stream"
+            else:
+                error = None
+                sampler = FrameSampler(**sampler_options)
+                frames_before = stats["frames_read"]
+                last_report = time.monotonic()
+                report(state=STREAMING)
+
+                while not stop_event.is_set():
+                    ret, frame = sampler.next_frame(cap, decoder_slots)
+
+                    if not ret:
+                        error = "Could not read frame"
+                        break
+
+                    # The stream is healthy again, so the next drop starts from the shortest delay
+                    attempt = 0
+                    stats["frames_read"] = frames_before + sampler.frame_count
+
+                    if frame is not None and scene_gate is not None and not scene_gate.should_write(camera_id, frame):
+                        stats["images_suppressed"] += 1
+                        frame = None
+
+                    if frame is not None:
+                        filename = namer.next_path()
+                        cv2.imwrite(filename, frame)
+                        stats["images_saved"] += 1
+                        stats["last_frame_at"] = time.time()
+
+                    if time.monotonic() - last_report >= report_interval:
+                        report()
+                        last_report = time.monotonic()
+        except Exception as e:
+            error = str(e)
+        finally:
+            cap.release()
+
+        if stop_event.is_set():
+            break
+
+        delay = backoff_delay(attempt, backoff_base, backoff_max)
+        attempt += 1
+        report(state=BACKOFF, last_error=error, reconnects=stats["reconnects"] + 1)
+        stop_event.wait(delay)
+
+    report(state=STOPPED)
+
+
+def _worker_main(rtsp_urls, save_directory, sampler_options, decoder_budget, status_queue, stop_event,
+                 backoff_base, backoff_max, report_interval, scene_change_threshold=None):
+    """
+    Entry point of a worker process: one capture thread per assigned camera, sharing
+    ``decoder_budget`` decode slots. The slots live in this process, so a crashed
+    worker takes its permits with it and its replacement starts with a full budget.
+    """
+    decoder_slots = threading.BoundedSemaphore(decoder_budget)
+    # Gate state is per camera and every camera lives in exactly one worker
+    scene_gate = None if scene_change_threshold is None else SceneChangeGate(scene_change_threshold)
+    threads = [
+        threading.Thread(
+            target=_camera_loop,
+            args=(rtsp_url, save_directory, sampler_options, decoder_slots, status_queue, stop_event,
+                  backoff_base, backoff_max, report_interval, scene_gate),
+            daemon=True,
+        )
+        for rtsp_url in rtsp_urls
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class CameraSupervisor:
+    """
+    Run many camera captures continuously on a bounded pool of worker processes.
+
+    Cameras are sharded round-robin over ``num_workers`` processes. Dropped streams are
+    reopened with jittered exponential backoff, at most ``max_decoders`` frames are
+    decoded at once across the whole pool, and crashed workers are restarted. The
+    decode budget is split over the workers, so waiting on a stream or a crashed
+    worker never holds up decoding elsewhere.
+    Local video files work as sources too: reaching the end of the file is treated as
+    a drop, so the file is reopened and loops.
+
+    Args:
+        rtsp_urls (list): Stream URLs or local video paths
+        save_directory (str): Folder to save the sampled frames in
+        num_workers (int, optional): Number of worker processes. Defaults to the CPU count,
+            and is lowered to ``max_decoders`` so every worker gets a decode slot.
+        max_decoders (int, optional): Maximum concurrent decodes, split over the workers.
+            Defaults to ``num_workers``.
+        frame_interval (int): Keep one frame out of this many
+        sample_seconds (float, optional): Keep one frame every this many seconds instead
+        skip_decode (bool): Grab skipped frames without retrieving them
+        backoff_base (float): First reconnect delay in seconds
+        backoff_max (float): Maximum reconnect delay in seconds
+        report_interval (float): Seconds between health reports of a streaming camera
+        scene_change_threshold (int, optional): Enable the scene-change gate and only save
+            frames whose hash differs from the last saved frame by at least this many bits
+    """
+
+    def __init__(self, rtsp_urls, save_directory="all_cameras_images", num_workers=None, max_decoders=None,
+                 frame_interval=125, sample_seconds=None, skip_decode=True, backoff_base=1.0,
+                 backoff_max=60.0, report_interval=5.0, scene_change_threshold=None):
+        self.rtsp_urls = list(rtsp_urls)
+        self.save_directory = save_directory
+        self.num_workers = max(1, min(num_workers or os.cpu_count() or 1, len(self.rtsp_urls) or 1))
+        if max_decoders is not None and max_decoders < 1:
+            raise ValueError(f"max_decoders must be at least 1, got {max_decoders}")
+        # A worker without a decode slot could never save a frame, so there are no more
+        # workers than slots
+        self.num_workers = min(self.num_workers, max_decoders or self.num_workers)
+        self.max_decoders = max_decoders or self.num_workers
+        self.sampler_options = {
+            "frame_interval": frame_interval,
+            "sample_seconds": sample_seconds,
+            "skip_decode": skip_decode,
+        }
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.report_interval = report_interval
+        self.scene_change_threshold = scene_change_threshold
+
+        # Spawn keeps the FFmpeg/OpenCV state of the parent out of the workers
+        self._context = multiprocessing.get_context("spawn")
+        self._stop_event = self._context.Event()
+        self._status_queue = self._context.Queue()
+        self._shards = [self.rtsp_urls[i::self.num_workers] for i in range(self.num_workers)]
+        self._decoder_budgets = [
+            self.max_decoders // self.num_workers + (i < self.max_decoders % self.num_workers)
+            for i in range(self.num_workers)
+        ]
+        self._processes = [None] * self.num_workers
+        self._health = {
+            rtsp_url: {"camera_id": camera_id_from_url(rtsp_url), "state": CONNECTING}
+            for rtsp_url in self.rtsp_urls
+        }
+        self._lock = threading.Lock()
+        self._monitor_thread = None
+        self.worker_restarts = 0
+
+    def _spawn(self, index):
+        process = self._context.Process(
+            target=_worker_main,
+            args=(self._shards[index], self.save_directory, self.sampler_options, self._decoder_budgets[index],
+                  self._status_queue, self._stop_event, self.backoff_base, self.backoff_max,
+                  self.report_interval, self.scene_change_threshold),
+            daemon=True,
+        )
+        process.start()
+        self._processes[index] = process
+
+    def _monitor(self):
+        while not self._stop_event.is_set():
+            self._drain_status(timeout=0.5)
+            for index, process in enumerate(self._processes):
+                if process is not None and not process.is_alive() and not self._stop_event.is_set():
+                    print(f"Worker {process.pid} exited with code {process.exitcode}, restarting")
+                    self.worker_restarts += 1
+                    self._spawn(index)
+
+    def _drain_status(self, timeout=0.0):
+        try:
+            rtsp_url, stats = self._status_queue.get(timeout=timeout)
+            while True:
+                with self._lock:
+                    self._health[rtsp_url] = stats
+                rtsp_url, stats = self._status_queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def start(self):
+        """Start the worker processes and the health monitor."""
+        os.makedirs(self.save_directory, exist_ok=True)
+        for index in range(self.num_workers):
+            self._spawn(index)
+        self._monitor_thread = threading.Thread(target=self._monitor, daemon=True)
+        self._monitor_thread.start()
+        return self
+
+    def stop(self, timeout=10):
+        """
+        Signal all cameras to stop and wait for the workers to exit.
+
+        Args:
+            timeout (float): Seconds to wait for each worker before terminating it
+        """
+        self._stop_event.set()
+        if self._monitor_thread is not None:
+            self._monitor_thread.join()
+        for process in self._processes:
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self._drain_status()
+
+    def health(self):
+        """
+        Latest health report of every camera.
+
+        Returns:
+            dict: Stream URL -> state, frame/image counters, reconnects and last error
+        """
+        with self._lock:
+            return {rtsp_url: dict(stats) for rtsp_url, stats in self._health.items()}
+
+    def summary(self):
+        """
+        Count cameras per state.
+
+        Returns:
+            dict: State -> number of cameras in that state
+        """
+        counts = {}
+        for stats in self.health().values():
+            counts[stats["state"]] = counts.get(stats["state"], 0) + 1
+        return counts
+
+    def run(self, duration_seconds=None, status_interval=30):
+        """
+        Run the supervisor in the foreground, printing a health summary periodically.
+
+        Args:
+            duration_seconds (float, optional): Stop after this many seconds. Runs until
+                interrupted when omitted.
+            status_interval (float): Seconds between printed summaries
+        """
+        self.start()
+        end_time = None if duration_seconds is None else time.time() + duration_seconds
+        try:
+            while end_time is None or time.time() < end_time:
+                wait = status_interval if end_time is None else min(status_interval, end_time - time.time())
+                time.sleep(max(0, wait))
+                print(f"Camera health: {self.summary()}")
+                if self.scene_change_threshold is not None:
+                    suppressed = sum(stats.get("images_suppressed", 0) for stats in self.health().values())
+                    print(f"Scene gate suppressed {suppressed} unchanged frames so far")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+        print("Camera supervisor stopped.")
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+if __name__ == "__main__":
+    CameraSupervisor(RTSP_URLS, sample_seconds=5).run()
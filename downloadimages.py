@@ -1,18 +1,170 @@
 import cv2
 import time
 import os
+import contextlib
 import requests
 import threading
 
-def download_images_from_camera(rtsp_url, save_directory, frame_interval=125, duration_seconds=300):
+
+def camera_id_from_url(rtsp_url):
+    """
+    Extract the camera id from a stream URL.
+
+    Args:
+        rtsp_url (str): Stream URL with a ``src=<id>`` query parameter, or a local video path
+
+    Returns:
+        str: The ``src`` value, or the file name without extension for local sources
+    """
+    if 'src=' in rtsp_url:
+        return rtsp_url.split('src=')[1].split('&')[0]
+    return os.path.splitext(os.path.basename(rtsp_url))[0]
+
+
+def build_image_path(save_directory, camera_id):
+    """
+    Build the timestamped path a captured frame is written to.
+
+    Args:
+        save_directory (str): Folder the images are saved in
+        camera_id (str): Camera id used in the file name
+
+    Returns:
+        str: ``<save_directory>/camera_<id>_image_<YYYYmmdd_HHMMSS>.jpg``
+    """
+    timestamp = time.strftime("%Y%m%d_%H%M%S")
+    return os.path.join(save_directory, f"camera_{camera_id}_image_{timestamp}.jpg")
+
+
+class FrameNamer:
+    """
+    Unique timestamped paths for the frames of one camera.
+
+    ``build_image_path`` names have one-second resolution, so frames kept within
+    the same second are numbered (``..._HHMMSS_1.jpg``, ``..._HHMMSS_2.jpg``)
+    instead of overwriting each other.
+
+    Args:
+        save_directory (str): Folder the images are saved in
+        camera_id (str): Camera id used in the file name
+    """
+
+    def __init__(self, save_directory, camera_id):
+        self.save_directory = save_directory
+        self.camera_id = camera_id
+        self._last_path = None
+        self._repeats = 0
+
+    def next_path(self):
+        """
+        Path for the next frame.
+
+        Returns:
+            str: ``build_image_path``, with ``_<n>`` appended for the n-th repeat within a second
+        """
+        path = build_image_path(self.save_directory, self.camera_id)
+        if path == self._last_path:
+            self._repeats += 1
+        else:
+            self._last_path, self._repeats = path, 0
+        if self._repeats:
+            return f"{os.path.splitext(path)[0]}_{self._repeats}.jpg"
+        return path
+
+
+class FrameSampler:
+    """
+    Decide which frames of a capture to keep and decode only those.
+
+    Frames are advanced with ``cap.grab()``, which demuxes the next frame without
+    converting it to a BGR image, and ``cap.retrieve()`` is only called for the
+    frames that are kept. Sampling is either count based (one frame every
+    ``frame_interval`` frames) or time based (one frame every ``sample_seconds``).
+
+    Args:
+        frame_interval (int): Keep one frame out of this many. Ignored when
+            ``sample_seconds`` is set.
+        sample_seconds (float, optional): Keep one frame every this many seconds.
+        skip_decode (bool): Grab skipped frames instead of reading them. Set to
+            False to decode every frame like the original loop.
+        clock (str): "wall" to sample on wall-clock time or "stream" to sample on
+            the stream's own timestamps (useful for file sources).
+    """
+
+    def __init__(self, frame_interval=125, sample_seconds=None, skip_decode=True, clock="wall"):
+        if clock not in ("wall", "stream"):
+            raise ValueError(f"Unknown clock '{clock}', expected 'wall' or 'stream'")
+        self.frame_interval = frame_interval
+        self.sample_seconds = sample_seconds
+        self.skip_decode = skip_decode
+        self.clock = clock
+        self.frame_count = 0
+        self.kept_count = 0
+        self._last_kept_at = None
+
+    def _now(self, cap):
+        if self.clock == "stream":
+            return cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+        return time.monotonic()
+
+    def _should_keep(self, cap):
+        if self.sample_seconds is None:
+            return self.frame_count % self.frame_interval == 0
+
+        now = self._now(cap)
+        # A clock that goes backwards means a looped or restarted source
+        if self._last_kept_at is None or now < self._last_kept_at or now - self._last_kept_at >= self.sample_seconds:
+            self._last_kept_at = now
+            return True
+        return False
+
+    def next_frame(self, cap, decode_slot=None):
+        """
+        Advance the capture by one frame.
+
+        Args:
+            cap (cv2.VideoCapture): Open capture to read from
+            decode_slot (optional): Context manager held while a frame is retrieved
+                (decoded), e.g. a semaphore bounding concurrent decodes. Grabbing,
+                which waits on the stream, runs outside it.
+
+        Returns:
+            tuple: (ok, frame) where ok is False when the stream could not be read
+            and frame is None for frames that were skipped
+        """
+        # read() is grab() plus retrieve(); splitting them keeps the wait for the
+        # stream out of the decode slot
+        if not cap.grab():
+            return False, None
+
+        self.frame_count += 1
+        keep = self._should_keep(cap)
+
+        if keep or not self.skip_decode:
+            with decode_slot if decode_slot is not None else contextlib.nullcontext():
+                ret, frame = cap.retrieve()
+            if not ret:
+                return False, None
+
+        if not keep:
+            return True, None
+
+        self.kept_count += 1
+        return True, frame
+
+
+def download_images_from_camera(rtsp_url, save_directory, frame_interval=125, duration_seconds=300,
+                                sample_seconds=None, skip_decode=True, scene_gate=None, clock="wall"):
     if not os.path.exists(save_directory):
         os.makedirs(save_directory)
 
     cap = None  # Initialize cap here
 
     try:
-        response = requests.get(rtsp_url, stream=True, timeout=10)
-        response.raise_for_status()
+        # Only HTTP sources can be checked up front; local video files go straight to OpenCV
+        if rtsp_url.startswith(("http://", "https://")):
+            response = requests.get(rtsp_url, stream=True, timeout=10)
+            response.raise_for_status()
 
         cap = cv2.VideoCapture(rtsp_url)  # Now cap is defined
 
@@ -22,21 +174,23 @@ def download_images_from_camera(rtsp_url, save_directory, frame_interval=125, du
 
         start_time = time.time()
         end_time = start_time + duration_seconds
-        frame_count = 0
+        sampler = FrameSampler(frame_interval, sample_seconds=sample_seconds, skip_decode=skip_decode, clock=clock)
+        namer = FrameNamer(save_directory, camera_id_from_url(rtsp_url))
         image_count = 0
 
         while time.time() < end_time:
-            ret, frame = cap.read()
+            ret, frame = sampler.next_frame(cap)
 
             if not ret:
                 print(f"Error: Could not read frame from {rtsp_url}. Check camera connection.")
                 break
 
-            frame_count += 1
+            if frame is not None:
+                camera_id = camera_id_from_url(rtsp_url)
+                if scene_gate is not None and not scene_gate.should_write(camera_id, frame):
+                    continue
 
-            if frame_count % frame_interval == 0:
-                timestamp = time.strftime("%Y%m%d_%H%M%S")
-                filename = os.path.join(save_directory, f"camera_{rtsp_url.split('src=')[1].split('&')[0]}_image_{timestamp}.jpg")
+                filename = namer.next_path()
                 cv2.imwrite(filename, frame)
                 print(f"Downloaded image: {filename} from {rtsp_url}")
 
@@ -50,31 +204,41 @@ def download_images_from_camera(rtsp_url, save_directory, frame_interval=125, du
         if cap is not None:
             cap.release()  # Release the capture object in the finally block
 
+    if scene_gate is not None:
+        gate_stats = scene_gate.stats(camera_id_from_url(rtsp_url))
+        print(f"Scene gate suppressed {gate_stats['suppressed']} unchanged frames from {rtsp_url}.")
+
     print(f"Finished downloading images from {rtsp_url}.")  # Print this even if no images were downloaded
 
 
-def process_rtsp_links(rtsp_urls, save_directory="all_cameras_images", frame_interval=125, duration_seconds=300):
+def process_rtsp_links(rtsp_urls, save_directory="all_cameras_images", frame_interval=125, duration_seconds=300,
+                       sample_seconds=None, skip_decode=True, scene_gate=None, clock="wall"):
     if not os.path.exists(save_directory):  # Create the main directory if it doesn't exist
         os.makedirs(save_directory)
     threads = []
     for rtsp_url in rtsp_urls:
-        thread = threading.Thread(target=download_images_from_camera, args=(rtsp_url, save_directory, frame_interval, duration_seconds))
+        thread = threading.Thread(target=download_images_from_camera, args=(rtsp_url, save_directory, frame_interval, duration_seconds, sample_seconds, skip_decode, scene_gate, clock))
         threads.append(thread)
         thread.start()
 
     for thread in threads:
         thread.join()
 
+    if scene_gate is not None:
+        gate_stats = scene_gate.stats()
+        print(f"Scene gate kept {gate_stats['kept']} and suppressed {gate_stats['suppressed']} frames in total.")
+
     print("All RTSP downloads complete.")
 
 
+RTSP_URLS = [
+    "https://vip-hls.backend-ripik.com/api/stream.m3u8?src=3&mp4",
+    "https://vip-hls.backend-ripik.com/api/stream.m3u8?src=2&mp4",
+    "https://vip-hls.backend-ripik.com/api/stream.m3u8?src=1&mp4",
+    "https://vip-hls.backend-ripik.com/api/stream.m3u8?src=6&mp4",
+    "https://vip-hls.backend-ripik.com/api/stream.m3u8?src=4&mp4",
+]
+
+
 if __name__ == "__main__":
-    rtsp_urls = [
-        "https://vip-hls.backend-ripik.com/api/stream.m3u8?src=3&mp4",
-        "https://vip-hls.backend-ripik.com/api/stream.m3u8?src=2&mp4",
-        "https://vip-hls.backend-ripik.com/api/stream.m3u8?src=1&mp4",
-        "https://vip-hls.backend-ripik.com/api/stream.m3u8?src=6&mp4",
-        "https://vip-hls.backend-ripik.com/api/stream.m3u8?src=4&mp4",
-    ]
-
-    process_rtsp_links(rtsp_urls)
\ No newline at end of file
+    process_rtsp_links(RTSP_URLS)
\ No newline at end of file
@@ -0,0 +1,407 @@
+import io
+import re
+import math
+import json
+import time
+import uuid
+import random
+import base64
+import hashlib
+import logging
+import threading
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import google.generativeai as genai
+import google.generativeai.client as genai_client
+from PIL import Image
+
+from rate_limiter import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+def _timestamp(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _discovery_document(base_url):
+    """Minimal discovery document with the ``media.upload`` method used by ``genai.upload_file``."""
+    return {
+        "kind": "discovery#restDescription",
+        "discoveryVersion": "v1",
+        "id": "generativelanguage:v1beta",
+        "name": "generativelanguage",
+        "version": "v1beta",
+        "protocol": "rest",
+        "rootUrl": base_url + "/",
+        "servicePath": "",
+        "baseUrl": base_url + "/",
+        "batchPath": "batch",
+        "parameters": {
+            "key": {"type": "string", "location": "query"},
+            "alt": {"type": "string", "location": "query", "default": "json"},
+        },
+        "schemas": {
+            "CreateFileRequest": {"id": "CreateFileRequest", "type": "object",
+                                  "properties": {"file": {"type": "object"}}},
+            "CreateFileResponse": {"id": "CreateFileResponse", "type": "object",
+                                   "properties": {"file": {"type": "object"}}},
+        },
+        "resources": {
+            "media": {
+                "methods": {
+                    "upload": {
+                        "id": "generativelanguage.media.upload",
+                        "path": "v1beta/files",
+                        "flatPath": "v1beta/files",
+                        "httpMethod": "POST",
+                        "parameters": {},
+                        "parameterOrder": [],
+                        "request": {"$ref": "CreateFileRequest"},
+                        "response": {"$ref": "CreateFileResponse"},
+                        "supportsMediaUpload": True,
+                        "mediaUpload": {
+                            "accept": ["*/*"],
+                            "protocols": {
+                                "simple": {"multipart": True, "path": "/upload/v1beta/files"},
+                                "resumable": {"multipart": True, "path": "/resumable/upload/v1beta/files"},
+                            },
+                        },
+                    }
+                }
+            }
+        },
+    }
+
+
+def image_token_count(part):
+    """
+    Input tokens of an image part the way Gemini 2.0 counts them: 258 for an image
+    with both sides up to 384 pixels, otherwise 258 per 768x768 tile it is cut into.
+    Uploaded files are counted as one tile.
+    """
+    if "inlineData" not in part:
+        return 258
+    try:
+        with Image.open(io.BytesIO(base64.b64decode(part["inlineData"]["data"]))) as img:
+            width, height = img.size
+    except Exception:
+        return 258
+    if width <= 384 and height <= 384:
+        return 258
+    return 258 * math.ceil(width / 768) * math.ceil(height / 768)
+
+
+def default_responder(image_ids, prompt):
+    """Answer every image with a fixed "no" verdict in the JSON format the prompt asks for."""
+    return json.dumps([
+        {"id": image_id, "verdict": "no", "confidence": 0.9,
+         "explanation": "No phone is visible in this stand-in response."}
+        for image_id in image_ids
+    ], indent=1)
+
+
+class FakeGeminiServer:
+    """
+    Local stand-in for the Gemini upload and generate endpoints.
+
+    Serves just enough of the REST API for ``genai.upload_file``, ``genai.get_file``
+    and ``GenerativeModel.generate_content`` (plain and streamed) to work against it,
+    so the pipeline can be measured offline. Call ``configure_genai`` to point the SDK
+    at the server.
+
+    Upload and generate requests can be made to fail: ``requests_per_minute`` answers
+    requests over the quota with 429 and a Retry-After header, ``throttle_rate`` and
+    ``error_rate`` answer a random fraction of requests with 429 or 500.
+
+    Args:
+        latency (float): Seconds added to every request
+        responder (callable, optional): ``responder(image_ids, prompt)`` returning the
+            generated text, where ``image_ids`` are taken from the "Image id: <id>"
+            labels in front of each image, or the "Frame ids: <id>, <id>" labels in
+            front of mosaics (numbered from 1 without labels).
+            Defaults to ``default_responder``.
+        host (str): Interface to bind
+        port (int): Port to bind, 0 picks a free port
+        image_latency (float): Seconds added to a generate request per image in it
+        error_rate (float): Fraction of upload and generate requests failing with 500
+        throttle_rate (float): Fraction of upload and generate requests failing with 429
+        requests_per_minute (float, optional): Quota of upload and generate requests
+        retry_after (float): Retry-After sent with randomly throttled requests
+        seed (int, optional): Seed of the random failures
+    """
+
+    def __init__(self, latency=0.0, responder=None, host="127.0.0.1", port=0, image_latency=0.0,
+                 error_rate=0.0, throttle_rate=0.0, requests_per_minute=None, retry_after=1.0, seed=None):
+        self.latency = latency
+        self.responder = responder or default_responder
+        self.image_latency = image_latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.quota = TokenBucket(requests_per_minute, burst_seconds=1.0) if requests_per_minute else None
+        self.files = {}
+        self.requests = {}
+        self.bytes_received = 0
+        self.errors = 0
+        self.throttled = 0
+        self._random = random.Random(seed)
+        self._uploads = {}
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def configure_genai(self, api_key="fake-key"):
+        """Point the ``google.generativeai`` SDK at this server."""
+        genai_client.GENAI_API_DISCOVERY_URL = f"{self.url}/$discovery/rest"
+        genai.configure(api_key=api_key, transport="rest", client_options={"api_endpoint": self.url})
+
+    def _count(self, endpoint, body_size):
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.bytes_received += body_size
+
+    def stats(self):
+        """
+        Counters since the server started or ``reset_stats`` was called.
+
+        Returns:
+            dict: Requests (total and per endpoint), bytes received, injected errors
+                and throttled requests, and the number of stored files
+        """
+        with self._lock:
+            return {
+                "requests": sum(self.requests.values()),
+                "endpoints": dict(self.requests),
+                "bytes_received": self.bytes_received,
+                "errors": self.errors,
+                "throttled": self.throttled,
+                "files": len(self.files),
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.requests = {}
+            self.bytes_received = 0
+            self.errors = 0
+            self.throttled = 0
+
+    def _fault(self):
+        """
+        Decide whether an upload or generate request fails.
+
+        Returns:
+            tuple or None: ``(status, status_name, headers)`` of the error response
+        """
+        if self.quota is not None:
+            wait = self.quota.try_acquire()
+            if wait:
+                with self._lock:
+                    self.throttled += 1
+                return 429, "RESOURCE_EXHAUSTED", {"Retry-After": str(math.ceil(wait))}
+        with self._lock:
+            draw = self._random.random()
+            if draw < self.throttle_rate:
+                self.throttled += 1
+                return 429, "RESOURCE_EXHAUSTED", {"Retry-After": f"{self.retry_after:g}"}
+            if draw < self.throttle_rate + self.error_rate:
+                self.errors += 1
+                return 500, "INTERNAL", {}
+        return None
+
+    def _store_file(self, data, mime_type, display_name):
+        now = time.time()
+        file_id = uuid.uuid4().hex[:16]
+        name = f"files/{file_id}"
+        record = {
+            "name": name,
+            "displayName": display_name or file_id,
+            "mimeType": mime_type,
+            "sizeBytes": str(len(data)),
+            "createTime": _timestamp(now),
+            "updateTime": _timestamp(now),
+            "expirationTime": _timestamp(now + 48 * 3600),
+            "sha256Hash": base64.b64encode(hashlib.sha256(data).digest()).decode("ascii"),
+            "uri": f"{self.url}/v1beta/{name}",
+            "state": "ACTIVE",
+        }
+        with self._lock:
+            self.files[name] = record
+        return record
+
+    def _generate(self, request):
+        parts = [part for content in request.get("contents", []) for part in content.get("parts", [])]
+        image_count = sum(1 for part in parts if "inlineData" in part or "fileData" in part)
+        image_tokens = sum(image_token_count(part) for part in parts if "inlineData" in part or "fileData" in part)
+        texts = [part["text"] for part in parts if "text" in part]
+        image_ids = []
+        for text in texts:
+            if text.startswith("Image id: "):
+                image_ids.append(text[len("Image id: "):])
+            elif text.startswith("Frame ids: "):
+                image_ids.extend(text[len("Frame ids: "):].split(", "))
+        prompt = "\n".join(text for text in texts if not text.startswith(("Image id: ", "Frame ids: ")))
+        text = self.responder(image_ids or [str(i) for i in range(1, image_count + 1)], prompt)
+        if self.image_latency:
+            time.sleep(self.image_latency * image_count)
+        usage = {
+            "promptTokenCount": image_tokens + len(prompt) // 4,
+            "candidatesTokenCount": len(text) // 4,
+            "totalTokenCount": image_tokens + len(prompt) // 4 + len(text) // 4,
+        }
+        return text, usage
+
+    @staticmethod
+    def _response(text, usage, finish_reason="STOP"):
+        candidate = {"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}
+        if finish_reason:
+            candidate["finishReason"] = finish_reason
+        return {"candidates": [candidate], "usageMetadata": usage}
+
+    def _stream_chunks(self, request, chunk_count=4):
+        """Split a generated response into the chunks of a streamed response."""
+        text, usage = self._generate(request)
+        size = max(1, -(-len(text) // chunk_count))
+        pieces = [text[i:i + size] for i in range(0, len(text), size)] or [""]
+        return [
+            self._response(piece, usage, "STOP" if i == len(pieces) - 1 else None)
+            for i, piece in enumerate(pieces)
+        ]
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                logger.debug("%s - %s", self.address_string(), format % args)
+
+            def _body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return self.rfile.read(length) if length else b""
+
+            def _send_json(self, payload, status=200, headers=None):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=UTF-8")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_stream(self, chunks):
+                # streamGenerateContent answers with one JSON array, written element
+                # by element with chunked transfer encoding
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json; charset=UTF-8")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for i, chunk in enumerate(chunks):
+                    data = (("[" if i == 0 else ",\r\n") + json.dumps(chunk)).encode("utf-8")
+                    self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                    self.wfile.flush()
+                self.wfile.write(b"1\r\n]\r\n0\r\n\r\n")
+
+            def _handle(self, method):
+                body = self._body()
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                path = url.path
+                endpoint = f"{method} {re.sub(r'files/[^/:]+', 'files/*', path)}"
+                server._count(endpoint, len(body))
+                if server.latency:
+                    time.sleep(server.latency)
+
+                if method == "GET" and path.endswith("/$discovery/rest"):
+                    return self._send_json(_discovery_document(server.url))
+
+                if path.startswith("/upload/") or path.endswith((":generateContent", ":streamGenerateContent")):
+                    fault = server._fault()
+                    if fault is not None:
+                        status, status_name, headers = fault
+                        return self._send_json({"error": {"code": status, "message": "Injected by FakeGeminiServer",
+                                                          "status": status_name}}, status=status, headers=headers)
+
+                # Resumable upload: the first request carries metadata, the second the bytes
+                if method == "POST" and path.startswith("/upload/") and query.get("uploadType") == ["resumable"]:
+                    metadata = json.loads(body or b"{}").get("file", {})
+                    upload_id = uuid.uuid4().hex
+                    with server._lock:
+                        server._uploads[upload_id] = (self.headers.get("X-Upload-Content-Type"), metadata)
+                    location = f"{server.url}/upload/v1beta/files?uploadType=resumable&upload_id={upload_id}"
+                    return self._send_json({}, headers={"Location": location})
+
+                if method in ("PUT", "POST") and path.startswith("/upload/") and "upload_id" in query:
+                    with server._lock:
+                        mime_type, metadata = server._uploads.pop(query["upload_id"][0])
+                    record = server._store_file(body, mime_type, metadata.get("displayName"))
+                    return self._send_json({"file": record})
+
+                if method == "POST" and path.startswith("/upload/"):
+                    # Multipart upload: store the whole body as the file content
+                    record = server._store_file(body, self.headers.get("Content-Type"), None)
+                    return self._send_json({"file": record})
+
+                match = re.match(r"^/v1beta/(files/[^/:]+)$", path)
+                if match:
+                    with server._lock:
+                        record = server.files.get(match.group(1))
+                        if method == "DELETE" and record is not None:
+                            del server.files[match.group(1)]
+                    if record is None:
+                        return self._send_json({"error": {"code": 404, "message": "File not found",
+                                                          "status": "NOT_FOUND"}}, status=404)
+                    return self._send_json({} if method == "DELETE" else record)
+
+                if method == "GET" and path == "/v1beta/files":
+                    with server._lock:
+                        files = list(server.files.values())
+                    return self._send_json({"files": files})
+
+                if method == "POST" and path.endswith(":generateContent"):
+                    return self._send_json(server._response(*server._generate(json.loads(body or b"{}"))))
+
+                if method == "POST" and path.endswith(":streamGenerateContent"):
+                    return self._send_stream(server._stream_chunks(json.loads(body or b"{}")))
+
+                self._send_json({"error": {"code": 404, "message": f"No route for {method} {path}",
+                                           "status": "NOT_FOUND"}}, status=404)
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def do_PUT(self):
+                self._handle("PUT")
+
+            def do_DELETE(self):
+                self._handle("DELETE")
+
+        return Handler
@@ -0,0 +1,325 @@
+import time
+import sqlite3
+import hashlib
+import logging
+import datetime
+import threading
+
+import google.generativeai as genai
+from google.generativeai import protos
+from google.generativeai.types import file_types
+
+from rate_limiter import error_status
+
+logger = logging.getLogger(__name__)
+
+
+class FileRegistry:
+    """
+    Local record of the files uploaded to the Gemini Files API, keyed by content hash.
+
+    Uploading the same bytes again returns the recorded handle instead, as long as
+    it is more than ``expiry_margin`` seconds away from expiring. The state of the
+    recorded files is checked in bulk with one ``genai.list_files`` listing at most
+    every ``sync_interval`` seconds rather than one request per file; handles that
+    no longer exist remotely or are not ACTIVE are forgotten. ``FileJanitor``
+    deletes handles that have not been used for a while. Safe to use from several
+    threads; the database is only opened on first use.
+
+    Args:
+        path (str): SQLite database file
+        expiry_margin (float, optional): Seconds before expiry from which a handle is
+            no longer reused
+        sync_interval (float, optional): Minimum seconds between two remote state checks
+        rate_limiter (RateLimiter, optional): Gate for the list and delete calls
+    """
+
+    def __init__(self, path="gemini_files.sqlite3", expiry_margin=3600, sync_interval=600, rate_limiter=None):
+        self.path = path
+        self.expiry_margin = expiry_margin
+        self.sync_interval = sync_interval
+        self.rate_limiter = rate_limiter
+        self.reused = 0
+        self._conn = None
+        self._synced_at = None
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            with self._conn:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS files ("
+                    "content_hash TEXT PRIMARY KEY, name TEXT NOT NULL, uri TEXT NOT NULL, mime_type TEXT, "
+                    "expires_at REAL NOT NULL, created_at REAL NOT NULL, used_at REAL NOT NULL)"
+                )
+                self._conn.execute("CREATE INDEX IF NOT EXISTS files_used_at ON files (used_at)")
+        return self._conn
+
+    def _call(self, fn, *args, **kwargs):
+        if self.rate_limiter is None:
+            return fn(*args, **kwargs)
+        return self.rate_limiter.call(fn, *args, **kwargs)
+
+    @staticmethod
+    def content_hash(data):
+        """
+        Registry key of the bytes of an upload.
+
+        Args:
+            data (bytes): Content of the uploaded file
+
+        Returns:
+            str: Hex SHA-256 digest
+        """
+        return hashlib.sha256(data).hexdigest()
+
+    def get(self, content_hash):
+        """
+        Look up a reusable handle for uploaded content.
+
+        Args:
+            content_hash (str): Key from ``content_hash``
+
+        Returns:
+            file_types.File or None: The recorded file, or None if it has to be uploaded
+        """
+        self.sync()
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT name, uri, mime_type, expires_at FROM files WHERE content_hash = ?", (content_hash,)
+            ).fetchone()
+            if row is None or row[3] - self.expiry_margin <= now:
+                return None
+            with conn:
+                conn.execute("UPDATE files SET used_at = ? WHERE content_hash = ?", (now, content_hash))
+            self.reused += 1
+
+        name, uri, mime_type, expires_at = row
+        return file_types.File(protos.File(
+            name=name,
+            uri=uri,
+            mime_type=mime_type,
+            expiration_time=datetime.datetime.fromtimestamp(expires_at, datetime.timezone.utc),
+            state=protos.File.State.ACTIVE,
+        ))
+
+    def touch(self, name):
+        """
+        Mark a recorded file as used, if it can still be used.
+
+        For handles kept elsewhere, such as the uploads recorded by ``JobJournal``:
+        files the janitor deleted, that disappeared remotely or are about to expire
+        are not recorded (anymore) and have to be uploaded again.
+
+        Args:
+            name (str): Gemini file name (``files/...``)
+
+        Returns:
+            bool: Whether the file is recorded and more than ``expiry_margin`` seconds from expiring
+        """
+        self.sync()
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                touched = conn.execute(
+                    "UPDATE files SET used_at = ? WHERE name = ? AND expires_at - ? > ?",
+                    (now, name, self.expiry_margin, now),
+                ).rowcount
+        return touched > 0
+
+    def put(self, content_hash, file):
+        """
+        Record a freshly uploaded file.
+
+        Args:
+            content_hash (str): Key from ``content_hash``
+            file (file_types.File): File returned by ``genai.upload_file``
+        """
+        now = time.time()
+        expires_at = file.expiration_time.timestamp() if file.expiration_time else now + 48 * 3600
+        with self._lock, self._connection():
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (content_hash, name, uri, mime_type, expires_at, created_at, used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (content_hash, file.name, file.uri, file.mime_type, expires_at, now, now),
+            )
+
+    def forget(self, names):
+        """
+        Drop handles from the registry, for example after they were deleted remotely.
+
+        Args:
+            names (list): Gemini file names (``files/...``)
+
+        Returns:
+            int: Number of removed handles
+        """
+        with self._lock, self._connection():
+            return self._conn.executemany("DELETE FROM files WHERE name = ?", [(name,) for name in names]).rowcount
+
+    def sync(self, force=False):
+        """
+        Check the recorded handles against the remote file list.
+
+        Runs at most every ``sync_interval`` seconds unless ``force`` is set; when
+        several threads ask at once, one lists and the others carry on.
+
+        Args:
+            force (bool, optional): List the remote files even if the last check is recent
+
+        Returns:
+            int: Number of handles forgotten
+        """
+        if not force and self._synced_at is not None and time.monotonic() - self._synced_at < self.sync_interval:
+            return 0
+        if not self._sync_lock.acquire(blocking=force):
+            return 0
+        try:
+            with self._lock:
+                names = [row[0] for row in self._connection().execute("SELECT name FROM files")]
+            if not names:
+                self._synced_at = time.monotonic()
+                return 0
+
+            try:
+                remote = {
+                    file.name: file for file in self._call(lambda: list(genai.list_files(page_size=100)))
+                }
+            except Exception as e:
+                logger.warning(f"Could not list Gemini files, keeping recorded handles: {e}")
+                return 0
+            finally:
+                self._synced_at = time.monotonic()
+
+            stale = [
+                name for name in names
+                if name not in remote or remote[name].state != protos.File.State.ACTIVE
+            ]
+            if stale:
+                logger.info(f"Forgetting {len(stale)} Gemini file handles that are gone or not active")
+                self.forget(stale)
+            return len(stale)
+        finally:
+            self._sync_lock.release()
+
+    def stale(self, idle_seconds, limit=None):
+        """
+        Handles that were not used for ``idle_seconds`` or are about to expire.
+
+        Args:
+            idle_seconds (float): Idle time after which a handle is stale
+            limit (int, optional): Maximum number of names to return
+
+        Returns:
+            list: Gemini file names, least recently used first
+        """
+        now = time.time()
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT name FROM files WHERE used_at < ? OR expires_at - ? <= ? ORDER BY used_at LIMIT ?",
+                (now - idle_seconds, self.expiry_margin, now, -1 if limit is None else limit),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self._connection().execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class FileJanitor:
+    """
+    Background thread deleting stale remote files recorded in a ``FileRegistry``.
+
+    Every ``interval`` seconds the handles that were not used for ``idle_seconds``
+    (or are about to expire) are deleted remotely, ``batch_size`` at a time, and
+    removed from the registry, keeping the project under its file storage quota.
+    Only files recorded in the registry are ever deleted.
+
+    Args:
+        registry (FileRegistry): Registry of the uploaded files
+        idle_seconds (float): Idle time after which a file is deleted
+        interval (float): Seconds between two cleanup rounds
+        batch_size (int): Files deleted per batch
+    """
+
+    def __init__(self, registry, idle_seconds=6 * 3600, interval=300, batch_size=20):
+        self.registry = registry
+        self.idle_seconds = idle_seconds
+        self.interval = interval
+        self.batch_size = batch_size
+        self.deleted = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _delete(self, name):
+        try:
+            self.registry._call(genai.delete_file, name)
+        except Exception as e:
+            # Already gone remotely is as good as deleted
+            if error_status(e) != 404:
+                logger.warning(f"Could not delete Gemini file {name}: {e}")
+                return False
+        return True
+
+    def run_once(self):
+        """
+        Delete all stale files now, batch by batch.
+
+        Returns:
+            int: Number of files deleted
+        """
+        deleted = 0
+        failed = set()
+        while not self._stop_event.is_set():
+            batch = [
+                name for name in self.registry.stale(self.idle_seconds, self.batch_size + len(failed))
+                if name not in failed
+            ][:self.batch_size]
+            if not batch:
+                break
+            done = [name for name in batch if self._delete(name)]
+            failed.update(set(batch) - set(done))
+            self.registry.forget(done)
+            deleted += len(done)
+        if deleted:
+            logger.info(f"Deleted {deleted} stale Gemini files")
+        self.deleted += deleted
+        return deleted
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Gemini file cleanup failed: {e}")
+            self._stop_event.wait(self.interval)
+
+    def start(self):
+        """Start the janitor thread."""
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the janitor thread after the current deletion."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
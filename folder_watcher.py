@@ -0,0 +1,424 @@
+import os
+import time
+import select
+import struct
+import ctypes
+import sqlite3
+import logging
+import threading
+import ctypes.util
+
+from objectdetection import (
+    BATCH_SIZE,
+    MAX_CONCURRENT_BATCHES,
+    PREPROCESS_WORKERS,
+    analyze_image_paths,
+    is_image_file,
+    make_preprocess_executor,
+)
+
+logger = logging.getLogger(__name__)
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class ProcessedJournal:
+    """
+    Persistent record of the images a ``FolderWatcher`` has analyzed, in a local SQLite file.
+
+    Images are recorded by file name together with their size and modification
+    time, so a file that is replaced under the same name is analyzed again. Safe to
+    use from several threads.
+
+    Args:
+        path (str): SQLite database file
+    """
+
+    def __init__(self, path="processed_images.sqlite3"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS processed ("
+                "name TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+                "answer TEXT NOT NULL, processed_at REAL NOT NULL)"
+            )
+
+    def is_processed(self, name, size, mtime_ns):
+        """
+        Whether this version of an image was analyzed already.
+
+        Args:
+            name (str): File name of the image
+            size (int): File size in bytes
+            mtime_ns (int): Modification time in nanoseconds
+
+        Returns:
+            bool: True if the journal holds the image with the same size and modification time
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT size, mtime_ns FROM processed WHERE name = ?", (name,)).fetchone()
+        return row is not None and tuple(row) == (size, mtime_ns)
+
+    def mark(self, entries):
+        """
+        Record analyzed images.
+
+        Args:
+            entries (list): ``(name, size, mtime_ns, answer)`` tuples
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO processed (name, size, mtime_ns, answer, processed_at) VALUES (?, ?, ?, ?, ?)",
+                [(name, size, mtime_ns, answer, now) for name, size, mtime_ns, answer in entries],
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM processed").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class InotifySource:
+    """
+    File names written to or moved into a folder, from Linux inotify.
+
+    Only completed files are reported (``IN_CLOSE_WRITE`` and ``IN_MOVED_TO``), so an
+    image is never picked up half written. Uses libc through ctypes, so it needs no
+    extra package; ``available`` tells whether it works on this system.
+
+    Args:
+        folder (str): Folder to watch
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if self._libc.inotify_add_watch(self._fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, f"Cannot watch {folder}")
+
+    @staticmethod
+    def available():
+        """Whether inotify can be used on this system."""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"))
+            return hasattr(libc, "inotify_init1")
+        except OSError:
+            return False
+
+    def wait(self, timeout):
+        """
+        Wait up to ``timeout`` seconds for changes.
+
+        Returns:
+            list or None: Names of the completed files, or None when events were lost
+            and the folder has to be scanned again
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+
+        names = []
+        while True:
+            try:
+                buffer = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset < len(buffer):
+                _, mask, _, length = _EVENT_HEADER.unpack_from(buffer, offset)
+                offset += _EVENT_HEADER.size
+                name = buffer[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if mask & (IN_Q_OVERFLOW | IN_IGNORED):
+                    return None
+                if name:
+                    names.append(os.fsdecode(name))
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingSource:
+    """
+    File names that appeared or changed in a folder, found by listing it every ``interval`` seconds.
+
+    A file is reported once its size and modification time are the same in two
+    consecutive listings, so files that are still being written are not picked up.
+
+    Args:
+        folder (str): Folder to watch
+        interval (float): Seconds between two listings
+    """
+
+    def __init__(self, folder, interval=1.0):
+        self.folder = folder
+        self.interval = interval
+        self._seen = {}
+        self._next_scan = time.monotonic()
+
+    def wait(self, timeout):
+        """
+        Wait up to ``timeout`` seconds for changes.
+
+        Returns:
+            list: Names of the files that are new or changed and no longer growing
+        """
+        delay = self._next_scan - time.monotonic()
+        if delay > timeout:
+            time.sleep(timeout)
+            return []
+        if delay > 0:
+            time.sleep(delay)
+        self._next_scan = time.monotonic() + self.interval
+
+        names = []
+        seen = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                previous_signature, reported = self._seen.get(entry.name, (None, False))
+                if previous_signature != signature:
+                    reported = False
+                elif not reported:
+                    names.append(entry.name)
+                    reported = True
+                seen[entry.name] = (signature, reported)
+        self._seen = seen
+        return names
+
+    def close(self):
+        pass
+
+
+class FolderWatcher:
+    """
+    Daemon that analyzes images as they arrive in a folder.
+
+    New files are picked up with inotify where available and by polling otherwise,
+    and collected into micro-batches. A micro-batch is analyzed as soon as it holds
+    ``batch_size`` images or its oldest image has waited ``max_latency`` seconds,
+    which trades request count against time to verdict: a small ``max_latency``
+    sends verdicts seconds after capture, a large one sends fuller requests. Images
+    arriving while a micro-batch is analyzed are collected for the next one, so the
+    batches grow on their own when images arrive faster than they are analyzed.
+
+    Analyzed images are recorded in a ``ProcessedJournal``; on start the images in
+    the folder that are not in the journal are analyzed first, so nothing captured
+    while the watcher was down is missed and nothing is analyzed twice. Images
+    without a verdict are retried up to ``max_attempts`` times.
+
+    Args:
+        image_folder (str): Folder to watch
+        journal (ProcessedJournal, optional): Record of analyzed images. Defaults to
+            ``processed_images.sqlite3``.
+        on_result (callable, optional): Called as ``on_result(file_name, result)`` for every verdict
+        batch_size (int): Images after which a micro-batch is sent right away
+        max_latency (float): Seconds an image waits at most for its micro-batch to fill
+        max_attempts (int): Analyses of an image before it is recorded as "unknown"
+        poll_interval (float): Seconds between two listings when polling
+        use_inotify (bool): Use inotify when available; False always polls
+        **analyze_options: Passed on to ``objectdetection.analyze_image_paths``
+            (``cache``, ``prefilter``, ``upload_mode``, ...)
+    """
+
+    def __init__(self, image_folder, journal=None, on_result=None, batch_size=BATCH_SIZE, max_latency=5.0,
+                 max_attempts=3, poll_interval=1.0, use_inotify=True, **analyze_options):
+        self.image_folder = image_folder
+        self.journal = journal if journal is not None else ProcessedJournal()
+        self.on_result = on_result
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.analyze_options = dict(analyze_options, batch_size=batch_size)
+
+        self.analyzed = 0
+        self.failed = 0
+        self._pending = {}
+        self._attempts = {}
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _open_source(self):
+        if self.use_inotify and InotifySource.available():
+            try:
+                return InotifySource(self.image_folder)
+            except OSError as e:
+                logger.warning(f"inotify unavailable ({e}), polling {self.image_folder} instead")
+        return PollingSource(self.image_folder, self.poll_interval)
+
+    def _consider(self, name):
+        # Queue an image unless it is pending or analyzed already in this version
+        if name in self._pending or not is_image_file(name):
+            return
+        try:
+            stat = os.stat(os.path.join(self.image_folder, name))
+        except FileNotFoundError:
+            return
+        if not self.journal.is_processed(name, stat.st_size, stat.st_mtime_ns):
+            self._pending[name] = (time.monotonic(), stat.st_size, stat.st_mtime_ns)
+
+    def scan(self):
+        """Queue every image in the folder that is not in the journal."""
+        for name in sorted(os.listdir(self.image_folder)):
+            self._consider(name)
+
+    def _due(self):
+        if not self._pending:
+            return False
+        if len(self._pending) >= self.batch_size:
+            return True
+        oldest = min(queued_at for queued_at, _, _ in self._pending.values())
+        return time.monotonic() - oldest >= self.max_latency
+
+    def _time_left(self):
+        if not self._pending:
+            return self.max_latency
+        oldest = min(queued_at for queued_at, _, _ in self._pending.values())
+        return max(0.0, self.max_latency - (time.monotonic() - oldest))
+
+    def flush(self, preprocess_executor=None):
+        """
+        Analyze the queued images, oldest first, and record them in the journal.
+
+        At most ``batch_size`` times ``max_concurrent_batches`` images are analyzed per
+        call, so a large backlog is journaled as it goes. Images that were removed
+        since they were queued are dropped; if the analysis raises, the images go
+        back into the queue and the exception is passed on.
+
+        Returns:
+            int: Number of images analyzed
+        """
+        limit = self.batch_size * self.analyze_options.get("max_concurrent_batches", MAX_CONCURRENT_BATCHES)
+        names = sorted(self._pending, key=lambda name: self._pending[name][0])[:limit]
+        queued = {}
+        for name in names:
+            queued_at, _, _ = self._pending.pop(name)
+            try:
+                stat = os.stat(os.path.join(self.image_folder, name))
+            except FileNotFoundError:
+                logger.warning(f"{name} was removed before it was analyzed, skipping it")
+                self._attempts.pop(name, None)
+                continue
+            # Record the version that is analyzed, in case the file was replaced meanwhile
+            queued[name] = (queued_at, stat.st_size, stat.st_mtime_ns)
+        if not queued:
+            return 0
+
+        try:
+            results = analyze_image_paths(
+                [os.path.join(self.image_folder, name) for name in queued],
+                on_result=self.on_result,
+                preprocess_executor=preprocess_executor,
+                **self.analyze_options,
+            )
+        except Exception:
+            self._pending.update(queued)
+            raise
+
+        done = []
+        for name, (_, size, mtime_ns) in queued.items():
+            result = results.get(name)
+            if result is not None and result["answer"] != "unknown":
+                done.append((name, size, mtime_ns, result["answer"]))
+                self._attempts.pop(name, None)
+                continue
+            self._attempts[name] = self._attempts.get(name, 0) + 1
+            if self._attempts[name] >= self.max_attempts:
+                logger.error(f"No verdict for {name} after {self._attempts[name]} attempts, giving up")
+                done.append((name, size, mtime_ns, "unknown"))
+                self._attempts.pop(name)
+                self.failed += 1
+            else:
+                self._pending[name] = (time.monotonic(), size, mtime_ns)
+
+        self.journal.mark(done)
+        self.analyzed += len(done)
+        return len(done)
+
+    def run(self):
+        """Watch the folder until ``stop`` is called."""
+        source = self._open_source()
+        logger.info(f"Watching {self.image_folder} with {type(source).__name__}")
+        workers = self.analyze_options.get("preprocess_workers", PREPROCESS_WORKERS)
+        # One preprocessing pool for the lifetime of the watcher instead of one per micro-batch
+        preprocess_executor = make_preprocess_executor(workers) if workers else None
+        try:
+            self.scan()
+            if self._pending:
+                logger.info(f"{len(self._pending)} images in {self.image_folder} have not been analyzed yet")
+            while not self._stop_event.is_set():
+                names = source.wait(min(self._time_left(), 1.0))
+                if names is None:
+                    logger.warning("inotify event queue overflowed, rescanning the folder")
+                    self.scan()
+                else:
+                    for name in names:
+                        self._consider(name)
+                if self._due():
+                    try:
+                        self.flush(preprocess_executor)
+                    except Exception as e:
+                        logger.error(f"Analysis of a micro-batch failed: {e}")
+                        self._stop_event.wait(self.poll_interval)
+        finally:
+            source.close()
+            if preprocess_executor is not None:
+                preprocess_executor.shutdown()
+            logger.info(f"Stopped watching {self.image_folder}: {self.analyzed} images analyzed, {self.failed} failed")
+
+    def start(self):
+        """Watch the folder in a background thread."""
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop watching after the current micro-batch."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+if __name__ == "__main__":
+    from file_registry import FileJanitor
+    from objectdetection import FILE_REGISTRY
+    from result_cache import ResultCache
+
+    def print_result(image, data):
+        print(f"{image}: {data['answer']} - {data['explanation']}")
+
+    watcher = FolderWatcher("all_cameras_images", on_result=print_result, cache=ResultCache())
+    with FileJanitor(FILE_REGISTRY):
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
@@ -1,12 +1,22 @@
 import streamlit as st
-import os
+import io
 import json
+import uuid
+import hashlib
 import pandas as pd
 import matplotlib.pyplot as plt
-from PIL import Image
 import seaborn as sns
-from objectdetection import analyze_all_images
-import time
+from image_preprocessing import make_thumbnail
+from objectdetection import ImageBuffer, is_image_file
+from job_runner import DONE, QUEUED, RUNNING, JobRunner
+from result_cache import ResultCache
+
+@st.cache_resource
+def get_result_cache():
+    """
+    Result cache shared by all sessions of the app
+    """
+    return ResultCache()
 
 def select_folder():
     """
@@ -15,26 +25,222 @@ def select_folder():
     uploaded_files = st.file_uploader("Select Image Folder", accept_multiple_files=True, type=['png', 'jpg', 'jpeg', 'gif', 'bmp'])
     return uploaded_files
 
-def save_uploaded_files(uploaded_files):
+def uploaded_images(uploaded_files):
+    """
+    Uploaded images to analyze, in name order, as views of the uploads in memory:
+    nothing is copied or written to disk
+    """
+    return [
+        ImageBuffer(uploaded_file.name, uploaded_file.getbuffer())
+        for uploaded_file in sorted(uploaded_files, key=lambda f: f.name)
+        if is_image_file(uploaded_file.name)
+    ]
+
+def file_digest(uploaded_file):
+    """
+    SHA-256 of an uploaded file's content
+    """
+    return hashlib.sha256(uploaded_file.getbuffer()).hexdigest()
+
+def upload_set_key(uploaded_files):
+    """
+    Key of a set of uploads: the same files with the same names give the same key on every rerun
+    """
+    digest = hashlib.sha256()
+    for uploaded_file in sorted(uploaded_files, key=lambda f: f.name):
+        digest.update(uploaded_file.name.encode())
+        digest.update(file_digest(uploaded_file).encode())
+    return digest.hexdigest()
+
+@st.cache_data(show_spinner=False)
+def preview_thumbnail(digest, _data, size=(512, 512)):
+    """
+    Small JPEG preview of an image, decoded at reduced size and cached by the digest of its content
+    """
+    return make_thumbnail(_data, size)
+
+@st.cache_data(show_spinner=False)
+def results_frame(key, _results):
+    """
+    Results table of an upload set, cached by its key
+    """
+    rows = []
+    for image, data in _results.items():
+        rows.append({
+            'Image': image,
+            'Phone Usage': data['answer'].capitalize(),
+            'Confidence': data.get('confidence'),
+            'Explanation': data['explanation']
+        })
+    return pd.DataFrame(rows, columns=['Image', 'Phone Usage', 'Confidence', 'Explanation'])
+
+def figure_png(fig):
+    """
+    Render a matplotlib figure to PNG bytes and close it
     """
-    Save uploaded files to a temporary directory
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", bbox_inches="tight")
+    plt.close(fig)
+    return buffer.getvalue()
+
+@st.cache_data(show_spinner=False)
+def usage_chart(key, _results_df):
     """
-    if not uploaded_files:
-        return None
+    Pie chart of the verdicts of an upload set as PNG, cached by its key
+    """
+    usage_counts = _results_df['Phone Usage'].value_counts()
+    
+    # Custom color palette
+    colors = ['#4361ee', '#3a0ca3', '#4cc9f0', '#f72585', '#7209b7']
     
-    # Create a temporary directory
-    import tempfile
-    temp_dir = tempfile.mkdtemp()
+    fig1, ax1 = plt.subplots(figsize=(8, 6))
+    wedges, texts, autotexts = ax1.pie(
+        usage_counts.values, 
+        labels=usage_counts.index, 
+        autopct='%1.1f%%',
+        startangle=90,
+        colors=colors[:len(usage_counts)]
+    )
     
-    # Save uploaded files
-    file_paths = []
-    for uploaded_file in uploaded_files:
-        file_path = os.path.join(temp_dir, uploaded_file.name)
-        with open(file_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        file_paths.append(file_path)
+    # Customize pie chart
+    plt.setp(autotexts, size=10, weight="bold")
+    ax1.set_title('Phone Usage Types', fontsize=14, fontweight='bold')
     
-    return temp_dir
+    # Equal aspect ratio ensures that pie is drawn as a circle
+    ax1.axis('equal')
+    return figure_png(fig1)
+
+@st.cache_data(show_spinner=False)
+def explanation_length_chart(key, _results_df):
+    """
+    Histogram of the explanation lengths of an upload set as PNG, cached by its key
+    """
+    fig2, ax2 = plt.subplots(figsize=(8, 6))
+    sns.histplot(_results_df['Explanation'].str.len(), bins=10, kde=True, color='#4361ee', ax=ax2)
+    ax2.set_xlabel('Explanation Length (characters)', fontsize=12)
+    ax2.set_ylabel('Frequency', fontsize=12)
+    ax2.set_title('Distribution of Explanation Lengths', fontsize=14, fontweight='bold')
+    plt.tight_layout()
+    return figure_png(fig2)
+
+def render_results(key, results):
+    """
+    Show the results table, charts and download button of an upload set. Everything
+    is cached by ``key``, so reruns of the script render without recomputing.
+    """
+    results_df = results_frame(key, results)
+    
+    st.markdown("<h3 class='staggered-item-1'><span class='emoji'>📊</span> Analysis Results</h3>", unsafe_allow_html=True)
+    st.dataframe(results_df, use_container_width=True)
+
+    if results_df.empty:
+        return
+
+    # Generate Visualizations
+    st.markdown("<h3 class='staggered-item-2'><span class='emoji'>📈</span> Analysis Visualizations</h3>", unsafe_allow_html=True)
+    
+    # Usage Distribution
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        st.markdown('<div class="css-card">', unsafe_allow_html=True)
+        st.markdown("<h4><span class='emoji'>📊</span> Phone Usage Distribution</h4>", unsafe_allow_html=True)
+        st.image(usage_chart(key, results_df), use_container_width=True)
+        st.markdown('</div>', unsafe_allow_html=True)
+
+    with col2:
+        st.markdown('<div class="css-card">', unsafe_allow_html=True)
+        st.markdown("<h4><span class='emoji'>📏</span> Explanation Length Distribution</h4>", unsafe_allow_html=True)
+        st.image(explanation_length_chart(key, results_df), use_container_width=True)
+        st.markdown('</div>', unsafe_allow_html=True)
+
+    # Save Results Button
+    st.markdown('<div class="css-card" style="text-align: center;">', unsafe_allow_html=True)
+    st.download_button(
+        label="<span class='emoji'>💾</span> Save Results as JSON",
+        data=results_df.to_json(orient='records', indent=4),
+        file_name="image_analysis_results.json",
+        mime="application/json"
+    )
+    st.markdown('</div>', unsafe_allow_html=True)
+
+@st.cache_resource
+def get_job_runner():
+    """
+    Job runner shared by all sessions of the app, so concurrent analyses share one
+    compression pool and take turns instead of each starting their own
+    """
+    return JobRunner(cache=get_result_cache()).start()
+
+def session_owner():
+    """
+    Id of this browser session, which the job runner schedules fairly against other sessions
+    """
+    if "owner" not in st.session_state:
+        st.session_state["owner"] = uuid.uuid4().hex
+    return st.session_state["owner"]
+
+@st.fragment(run_every=0.5)
+def job_progress(job_id):
+    """
+    Live progress of a queued or running job: reruns on its own twice a second and
+    reruns the whole page once the job is finished
+    """
+    status = get_job_runner().status(job_id)
+    if status is None or status["state"] not in (QUEUED, RUNNING):
+        st.rerun()
+
+    if status["state"] == QUEUED:
+        st.markdown(f"""
+        <div class="info-message">
+            <span class="emoji">⏳</span> Waiting for {status["position"]} other analyses to start...
+        </div>
+        """, unsafe_allow_html=True)
+        return
+
+    total = max(status["total"], 1)
+    st.progress(int(100 * status["analyzed"] / total))
+    st.markdown(f"""
+    <div style="color:#4361ee;font-weight:bold;">
+        <div class="loading">
+            <div></div>
+            <div></div>
+        </div>
+        <span class="emoji">🔄</span> Analyzing images... compressed {status["compressed"]},
+        uploaded {status["uploaded"]}, analyzed {status["analyzed"]} of {status["total"]}
+    </div>
+    """, unsafe_allow_html=True)
+    # Verdicts show up as they arrive, while the batches are still running
+    if status["results"]:
+        st.dataframe(pd.DataFrame([
+            {'Image': image, 'Phone Usage': data['answer'].capitalize(), 'Confidence': data.get('confidence')}
+            for image, data in status["results"].items()
+        ]), use_container_width=True)
+
+def render_job(job_id):
+    """
+    Show a job: its live progress while it runs, its results once it is done
+    """
+    status = get_job_runner().status(job_id)
+    if status is None:
+        st.markdown('<div class="info-message">This analysis is no longer available, please run it again.</div>', unsafe_allow_html=True)
+        st.session_state.pop("job", None)
+        st.query_params.pop("job", None)
+        return
+    if status["state"] in (QUEUED, RUNNING):
+        job_progress(job_id)
+        return
+    if status["state"] != DONE:
+        st.markdown(f'<div class="error-message"><span class="emoji">❌</span> An error occurred: {status["error"] or status["state"]}</div>', unsafe_allow_html=True)
+        return
+
+    # Animated completion notification
+    st.markdown(f"""
+    <div class="success-message">
+        <span class="emoji">✅</span> Analysis complete! {len(status["results"])} images analyzed.
+    </div>
+    """, unsafe_allow_html=True)
+    render_results(job_id, status["results"])
 
 def main():
     # Set page config FIRST, before any other Streamlit commands
@@ -337,17 +543,11 @@ def main():
     </style>
     """, unsafe_allow_html=True)
     
-    # Animated app loading
-    with st.spinner('Loading app...'):
-        time.sleep(0.5)  # Short delay to show loading effect
-    
     # Title and description with animated emoji
     st.markdown("<h1><span class='emoji'>📱</span> Phone Usage Analyzer</h1>", unsafe_allow_html=True)
     
-    # Animated appearance of intro card
-    intro_placeholder = st.empty()
-    time.sleep(0.2)  # Brief delay for staggered animation
-    intro_placeholder.markdown("""
+    # The staggered appearance is done by the CSS animations, so nothing here waits
+    st.markdown("""
     <div class="css-card">
         <p class="staggered-item-1">Upload your smartphone screenshots and images to analyze your phone usage patterns and understand their context.</p>
         <p class="staggered-item-2">This tool uses advanced image recognition to identify how you use your phone.</p>
@@ -355,16 +555,12 @@ def main():
     </div>
     """, unsafe_allow_html=True)
 
-    # File Upload Section with animated appearance
-    upload_header = st.empty()
-    time.sleep(0.3)  # Brief delay for staggered animation
-    upload_header.markdown("<h3><span class='emoji'>📁</span> Upload Images</h3>", unsafe_allow_html=True)
-    
-    upload_card = st.empty()
-    time.sleep(0.2)  # Brief delay for staggered animation
-    upload_card.markdown('<div class="css-card">', unsafe_allow_html=True)
+    # File Upload Section
+    st.markdown("<h3><span class='emoji'>📁</span> Upload Images</h3>", unsafe_allow_html=True)
+    st.markdown('<div class="css-card">', unsafe_allow_html=True)
     
     uploaded_files = select_folder()
+    upload_key = upload_set_key(uploaded_files) if uploaded_files else None
 
     # Preview Images with staggered animation
     if uploaded_files:
@@ -373,12 +569,10 @@ def main():
         
         for i, uploaded_file in enumerate(uploaded_files[:4]):
             try:
-                img = Image.open(uploaded_file)
+                thumbnail = preview_thumbnail(file_digest(uploaded_file), uploaded_file.getbuffer())
                 with preview_cols[i]:
-                    # Staggered animation for each image
-                    time.sleep(0.1)
                     st.markdown(f'<div class="image-preview staggered-item-{i+1}">', unsafe_allow_html=True)
-                    st.image(img, caption=uploaded_file.name, use_container_width=True)
+                    st.image(thumbnail, caption=uploaded_file.name, use_container_width=True)
                     st.markdown('</div>', unsafe_allow_html=True)
             except Exception as e:
                 st.markdown(f'<div class="error-message">Error loading preview image {uploaded_file.name}: {e}</div>', unsafe_allow_html=True)
@@ -386,144 +580,41 @@ def main():
     # Analyze Button with enhanced styling and animation
     button_cols = st.columns([1, 2, 1])
     with button_cols[1]:
-        time.sleep(0.3)  # Brief delay for animated appearance
         analyze_button = st.button("🔍 Analyze Images", use_container_width=True)
     
     st.markdown('</div>', unsafe_allow_html=True)  # Close the upload card
 
-    # Analysis Logic with animated status updates
+    # Analysis runs as a job of the runner shared by all sessions. The job of this exact
+    # upload set is shown again on later runs of the script, e.g. after the download
+    # button was clicked, and the job id in the URL finds it after the tab was reloaded.
+    runner = get_job_runner()
+    job = st.session_state.get("job")
+    if job is None and "job" in st.query_params:
+        job = {"id": st.query_params["job"], "key": None}
+
     if analyze_button:
         # Validate file upload
         if not uploaded_files:
             st.markdown('<div class="error-message"><span class="emoji">⚠️</span> Please upload images</div>', unsafe_allow_html=True)
             return
 
-        # Progress indicators with animation
-        analysis_card = st.empty()
-        time.sleep(0.2)
-        analysis_card.markdown('<div class="css-card">', unsafe_allow_html=True)
-        
-        progress_bar = st.progress(0)
-        status_text = st.empty()
-
-        try:
-            # Save uploaded files to a temporary directory
-            image_folder = save_uploaded_files(uploaded_files)
-            
-            # Create a temporary compress folder
-            compress_folder = os.path.join(image_folder, 'compressed')
-            os.makedirs(compress_folder, exist_ok=True)
-            
-            # Animated analysis progress
-            status_text.markdown("""
-            <div style="color:#4361ee;font-weight:bold;">
-                <div class="loading">
-                    <div></div>
-                    <div></div>
-                </div>
-                <span class="emoji">🔄</span> Analyzing images...
-            </div>
-            """, unsafe_allow_html=True)
-            
-            # Simulate progress updates for visual feedback
-            for i in range(101):
-                progress_bar.progress(i)
-                time.sleep(0.01)  # Short delay for smoother animation
-            
-            # Run your actual analysis
-            results = analyze_all_images(image_folder, compress_folder)
-            
-            # Animated completion notification
-            status_text.markdown(f"""
-            <div class="success-message">
-                <span class="emoji">✅</span> Analysis complete! {len(results)} images analyzed.
-            </div>
-            """, unsafe_allow_html=True)
-
-            # Display Results with animation
-            results_df = []
-            for image, data in results.items():
-                results_df.append({
-                    'Image': image,
-                    'Phone Usage': data['answer'].capitalize(),
-                    'Explanation': data['explanation']
-                })
-
-            results_df = pd.DataFrame(results_df)
-            
-            # Animated results section
-            results_header = st.empty()
-            time.sleep(0.3)
-            results_header.markdown("<h3 class='staggered-item-1'><span class='emoji'>📊</span> Analysis Results</h3>", unsafe_allow_html=True)
-            
-            time.sleep(0.2)
-            st.dataframe(results_df, use_container_width=True)
-
-            # Generate Visualizations with animations
-            viz_header = st.empty()
-            time.sleep(0.3)
-            viz_header.markdown("<h3 class='staggered-item-2'><span class='emoji'>📈</span> Analysis Visualizations</h3>", unsafe_allow_html=True)
-            
-            # Usage Distribution
-            col1, col2 = st.columns(2)
-            
-            with col1:
-                time.sleep(0.2)
-                st.markdown('<div class="css-card">', unsafe_allow_html=True)
-                st.markdown("<h4><span class='emoji'>📊</span> Phone Usage Distribution</h4>", unsafe_allow_html=True)
-                usage_counts = results_df['Phone Usage'].value_counts()
-                
-                # Custom color palette
-                colors = ['#4361ee', '#3a0ca3', '#4cc9f0', '#f72585', '#7209b7']
-                
-                fig1, ax1 = plt.subplots(figsize=(8, 6))
-                wedges, texts, autotexts = ax1.pie(
-                    usage_counts.values, 
-                    labels=usage_counts.index, 
-                    autopct='%1.1f%%',
-                    startangle=90,
-                    colors=colors[:len(usage_counts)]
-                )
-                
-                # Customize pie chart
-                plt.setp(autotexts, size=10, weight="bold")
-                ax1.set_title('Phone Usage Types', fontsize=14, fontweight='bold')
-                
-                # Equal aspect ratio ensures that pie is drawn as a circle
-                ax1.axis('equal')
-                st.pyplot(fig1)
-                st.markdown('</div>', unsafe_allow_html=True)
-
-            with col2:
-                time.sleep(0.3)  # Slight delay for staggered appearance
-                st.markdown('<div class="css-card">', unsafe_allow_html=True)
-                st.markdown("<h4><span class='emoji'>📏</span> Explanation Length Distribution</h4>", unsafe_allow_html=True)
-                results_df['Explanation Length'] = results_df['Explanation'].str.len()
-                
-                fig2, ax2 = plt.subplots(figsize=(8, 6))
-                sns.histplot(results_df['Explanation Length'], bins=10, kde=True, color='#4361ee', ax=ax2)
-                ax2.set_xlabel('Explanation Length (characters)', fontsize=12)
-                ax2.set_ylabel('Frequency', fontsize=12)
-                ax2.set_title('Distribution of Explanation Lengths', fontsize=14, fontweight='bold')
-                plt.tight_layout()
-                st.pyplot(fig2)
-                st.markdown('</div>', unsafe_allow_html=True)
-
-            # Save Results Button with animation
-            save_button = st.empty()
-            time.sleep(0.4)  # Slight delay for staggered appearance
-            save_button.markdown('<div class="css-card" style="text-align: center;">', unsafe_allow_html=True)
-            save_results = st.download_button(
-                label="<span class='emoji'>💾</span> Save Results as JSON",
-                data=results_df.to_json(orient='records', indent=4),
-                file_name="image_analysis_results.json",
-                mime="application/json"
-            )
-            st.markdown('</div>', unsafe_allow_html=True)
+        if job is None or job["key"] != upload_key or runner.status(job["id"]) is None:
+            try:
+                # The job reads the uploads from memory and lets go of them when it is finished
+                job_id = runner.submit(uploaded_images(uploaded_files), owner=session_owner())
+            except Exception as e:
+                st.markdown(f'<div class="error-message"><span class="emoji">❌</span> An error occurred: {str(e)}</div>', unsafe_allow_html=True)
+                return
+            job = {"id": job_id, "key": upload_key}
+            st.session_state["job"] = job
+            st.query_params["job"] = job_id
+    elif job is not None and job["key"] not in (None, upload_key):
+        # Different uploads than the ones analyzed: wait for the button
+        return
 
-        except Exception as e:
-            st.markdown(f'<div class="error-message"><span class="emoji">❌</span> An error occurred: {str(e)}</div>', unsafe_allow_html=True)
-        
+    if job is not None:
+        st.markdown('<div class="css-card">', unsafe_allow_html=True)
+        render_job(job["id"])
         st.markdown('</div>', unsafe_allow_html=True)  # Close the analysis card
 
 def main_app():
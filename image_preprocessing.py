@@ -0,0 +1,321 @@
+import io
+import os
+import math
+import time
+import mimetypes
+
+from PIL import Image, ImageDraw, ImageFont
+
+# This module only depends on Pillow so that process pool workers can import it
+# quickly; the settings are passed in by objectdetection.
+
+# Images are passed either as a file path or as their encoded content
+BUFFER_TYPES = (bytes, bytearray, memoryview)
+
+
+def source_size(source):
+    """Size in bytes of an image given as a path or as its content."""
+    return len(source) if isinstance(source, BUFFER_TYPES) else os.path.getsize(source)
+
+
+def open_source(source):
+    """Open an image given as a path or as its content with Pillow."""
+    return Image.open(io.BytesIO(source) if isinstance(source, BUFFER_TYPES) else source)
+
+
+def read_source(source):
+    """
+    Encoded content and MIME type of an image given as a path or as its content.
+
+    Returns:
+        tuple: (bytes, mime_type). Content of unknown type is "application/octet-stream".
+    """
+    if isinstance(source, BUFFER_TYPES):
+        return bytes(source), "application/octet-stream"
+    mime_type, _ = mimetypes.guess_type(source)
+    with open(source, "rb") as f:
+        return f.read(), mime_type or "application/octet-stream"
+
+
+def scaled_size(size, max_side=None, max_pixels=None):
+    """
+    Size of an image after scaling it down to the side and pixel limits.
+
+    Args:
+        size (tuple): (width, height) of the image
+        max_side (int, optional): Maximum length of the longest side
+        max_pixels (int, optional): Maximum number of pixels
+
+    Returns:
+        tuple: (width, height), never larger than ``size``
+    """
+    width, height = size
+    scale = 1.0
+    if max_side:
+        scale = min(scale, max_side / max(width, height))
+    if max_pixels:
+        scale = min(scale, (max_pixels / (width * height)) ** 0.5)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def encode_jpeg(img, target_bytes, quality, min_quality):
+    """
+    Encode an image as JPEG at the highest quality that fits in ``target_bytes``.
+
+    Args:
+        img (PIL.Image.Image): RGB image
+        target_bytes (int): Size to stay under. None encodes at ``quality``.
+        quality (int): Highest quality to try
+        min_quality (int): Lowest quality to try
+
+    Returns:
+        tuple: (bytes, quality) of the encoded image. Uses ``min_quality`` when even
+        that does not fit.
+    """
+    def encode(q):
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=q, optimize=True)
+        return buffer.getvalue()
+
+    data = encode(quality)
+    if target_bytes is None or len(data) <= target_bytes:
+        return data, quality
+
+    # Binary search for the highest quality under the target
+    best, best_quality = None, None
+    low, high = min_quality, quality - 1
+    while low <= high:
+        mid = (low + high) // 2
+        candidate = encode(mid)
+        if len(candidate) <= target_bytes:
+            best, best_quality = candidate, mid
+            low = mid + 1
+        else:
+            high = mid - 1
+
+    if best is None:
+        return encode(min_quality), min_quality
+    return best, best_quality
+
+
+def preprocess_image(image_path, max_side, max_pixels, target_bytes, quality, min_quality, draft_tolerance=0.0):
+    """
+    Resize and compress an image into an in-memory JPEG.
+
+    JPEGs are decoded in Pillow's draft mode, which lets libjpeg decode directly at
+    1/2, 1/4 or 1/8 scale. When that scale lands within ``draft_tolerance`` below
+    the target size the image is used at that size as is, which skips the resize,
+    by far the most expensive step for camera frames.
+
+    Runs in process pool workers, so nothing is logged here; the caller logs and
+    records the returned details.
+
+    Args:
+        image_path (str or bytes): Path to the original image, or its encoded content
+        max_side (int): Maximum length of the longest side
+        max_pixels (int): Maximum number of pixels
+        target_bytes (int): Encoded size to aim for
+        quality (int): Highest JPEG quality to try
+        min_quality (int): Lowest JPEG quality to try
+        draft_tolerance (float, optional): Fraction the decoded size may fall short of
+            the target to skip the resize
+
+    Returns:
+        tuple: ``(bytes, mime_type, details)``. ``details`` holds original_bytes, size,
+        quality and seconds, or error when the image could not be compressed and the
+        original content is returned instead.
+    """
+    start = time.perf_counter()
+    try:
+        original_bytes = source_size(image_path)
+        with open_source(image_path) as img:
+            target_size = scaled_size(img.size, max_side, max_pixels)
+            # draft() picks the smallest DCT scale that is at least the requested size
+            img.draft("RGB", (
+                max(1, int(target_size[0] * (1 - draft_tolerance))),
+                max(1, int(target_size[1] * (1 - draft_tolerance))),
+            ))
+            img = img.convert("RGB") if img.mode != "RGB" else img.copy()
+        if img.size[0] > target_size[0] or img.size[1] > target_size[1]:
+            img = img.resize(target_size, Image.LANCZOS, reducing_gap=3.0)
+        data, used_quality = encode_jpeg(img, target_bytes, quality, min_quality)
+        return data, "image/jpeg", {
+            "original_bytes": original_bytes,
+            "size": img.size,
+            "quality": used_quality,
+            "seconds": time.perf_counter() - start,
+        }
+    except Exception as e:
+        data, mime_type = read_source(image_path)
+        return data, mime_type, {
+            "error": str(e),
+            "seconds": time.perf_counter() - start,
+        }
+
+
+def region_box(size, region):
+    """
+    Pixel box of a region of interest.
+
+    Args:
+        size (tuple): (width, height) of the image
+        region (tuple): (left, top, right, bottom) as fractions of the width and height
+
+    Returns:
+        tuple: (left, top, right, bottom) in pixels, inside the image and at least 1 pixel wide and high
+    """
+    width, height = size
+    left, top, right, bottom = region
+    left = min(max(0, round(left * width)), width - 1)
+    top = min(max(0, round(top * height)), height - 1)
+    right = min(max(left + 1, round(right * width)), width)
+    bottom = min(max(top + 1, round(bottom * height)), height)
+    return left, top, right, bottom
+
+
+def preprocess_regions(image_path, regions, max_side, max_pixels, target_bytes, quality, min_quality,
+                       draft_tolerance=0.0):
+    """
+    Crop an image to its regions of interest and compress every crop into an in-memory JPEG.
+
+    The image is decoded and scaled once, exactly like ``preprocess_image`` would,
+    and the crops are cut from the result, so each crop has the detail the whole
+    frame would have had and only the pixels outside the regions are saved.
+
+    Args:
+        image_path (str or bytes): Path to the original image, or its encoded content
+        regions (list): (left, top, right, bottom) fractions of the image, see ``region_box``
+        max_side (int): Maximum length of the longest side of the whole image
+        max_pixels (int): Maximum number of pixels of the whole image
+        target_bytes (int): Encoded size to aim for per crop
+        quality (int): Highest JPEG quality to try
+        min_quality (int): Lowest JPEG quality to try
+        draft_tolerance (float, optional): Fraction the decoded size may fall short of
+            the target to skip the resize
+
+    Returns:
+        list: One ``(bytes, mime_type, details)`` tuple per region, with details as
+        returned by ``preprocess_image``; the file's original_bytes are counted on the
+        first crop only. A single tuple with the original file content and an error
+        when the image could not be cropped.
+    """
+    start = time.perf_counter()
+    try:
+        original_bytes = source_size(image_path)
+        with open_source(image_path) as img:
+            target_size = scaled_size(img.size, max_side, max_pixels)
+            img.draft("RGB", (
+                max(1, int(target_size[0] * (1 - draft_tolerance))),
+                max(1, int(target_size[1] * (1 - draft_tolerance))),
+            ))
+            img = img.convert("RGB") if img.mode != "RGB" else img.copy()
+        if img.size[0] > target_size[0] or img.size[1] > target_size[1]:
+            img = img.resize(target_size, Image.LANCZOS, reducing_gap=3.0)
+
+        outputs = []
+        for index, region in enumerate(regions):
+            crop = img.crop(region_box(img.size, region))
+            data, used_quality = encode_jpeg(crop, target_bytes, quality, min_quality)
+            now = time.perf_counter()
+            outputs.append((data, "image/jpeg", {
+                "original_bytes": original_bytes if index == 0 else 0,
+                "size": crop.size,
+                "quality": used_quality,
+                "seconds": now - start,
+            }))
+            start = now
+        return outputs
+    except Exception as e:
+        data, mime_type = read_source(image_path)
+        return [(data, mime_type, {
+            "error": str(e),
+            "seconds": time.perf_counter() - start,
+        })]
+
+
+def build_mosaic(image_paths, labels, tile_size, target_bytes, quality, min_quality, columns=None):
+    """
+    Tile several images into one labelled grid and encode it as a JPEG.
+
+    Every image is scaled to fit ``tile_size`` (decoded in draft mode, keeping its
+    aspect ratio) and its label is drawn in the top left corner of its tile, so the
+    model can refer to each tile by label. Images that cannot be read are left out.
+
+    Args:
+        image_paths (list): Paths of the images or their encoded content, in tile order
+        labels (list): Label of each image
+        tile_size (tuple): (width, height) of a tile
+        target_bytes (int): Encoded size to aim for
+        quality (int): Highest JPEG quality to try
+        min_quality (int): Lowest JPEG quality to try
+        columns (int, optional): Tiles per row. Defaults to a near-square grid.
+
+    Returns:
+        tuple: ``(bytes, mime_type, details)``. ``details`` holds original_bytes,
+        size, quality and seconds like ``preprocess_image``, plus the labels of the
+        tiles in the mosaic and an error message per label that was left out.
+    """
+    start = time.perf_counter()
+    tiles, errors = [], {}
+    original_bytes = 0
+    for image_path, label in zip(image_paths, labels):
+        try:
+            with open_source(image_path) as img:
+                img.draft("RGB", tile_size)
+                tile = img.convert("RGB") if img.mode != "RGB" else img.copy()
+            tile.thumbnail(tile_size, Image.LANCZOS)
+            original_bytes += source_size(image_path)
+            tiles.append((label, tile))
+        except Exception as e:
+            errors[label] = str(e)
+
+    columns = columns or max(1, math.ceil(math.sqrt(len(tiles))))
+    rows = max(1, math.ceil(len(tiles) / columns))
+    tile_width, tile_height = tile_size
+    mosaic = Image.new("RGB", (columns * tile_width, rows * tile_height))
+    draw = ImageDraw.Draw(mosaic)
+    font = ImageFont.load_default(size=max(12, tile_height // 8))
+    for index, (label, tile) in enumerate(tiles):
+        x = (index % columns) * tile_width
+        y = (index // columns) * tile_height
+        mosaic.paste(tile, (x + (tile_width - tile.width) // 2, y + (tile_height - tile.height) // 2))
+        # White label on a black box, readable on any background
+        left, top, right, bottom = draw.textbbox((x + 6, y + 4), str(label), font=font)
+        draw.rectangle((x, y, right + 6, bottom + 4), fill="black")
+        draw.text((x + 6, y + 4), str(label), fill="white", font=font)
+        # Thin borders keep neighbouring frames apart
+        draw.rectangle((x, y, x + tile_width - 1, y + tile_height - 1), outline="white")
+
+    data, used_quality = encode_jpeg(mosaic, target_bytes, quality, min_quality)
+    return data, "image/jpeg", {
+        "original_bytes": original_bytes,
+        "size": mosaic.size,
+        "quality": used_quality,
+        "labels": [label for label, _ in tiles],
+        "errors": errors,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def make_thumbnail(source, size=(512, 512), quality=85):
+    """
+    Small JPEG preview of an image.
+
+    JPEGs are decoded in draft mode at the smallest DCT scale that still covers
+    ``size``, so a camera frame is never decoded at full resolution for a preview.
+
+    Args:
+        source (str or bytes): Path to the image, or its encoded content
+        size (tuple): Bounding box of the thumbnail
+        quality (int): JPEG quality
+
+    Returns:
+        bytes: The encoded thumbnail
+    """
+    with open_source(source) as img:
+        img.draft("RGB", size)
+        img = img.convert("RGB") if img.mode != "RGB" else img.copy()
+    img.thumbnail(size, Image.LANCZOS)
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
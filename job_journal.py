@@ -0,0 +1,181 @@
+import json
+import time
+import sqlite3
+import datetime
+import threading
+
+from google.generativeai import protos
+from google.generativeai.types import file_types
+
+# Per-image states, in the order an image goes through them
+COMPRESSED = "compressed"
+UPLOADED = "uploaded"
+ANALYZED = "analyzed"
+
+
+class JobJournal:
+    """
+    Durable record of how far each image of an analysis run got, in a local SQLite file.
+
+    Every image moves through ``compressed`` (with the compressed size), ``uploaded``
+    (with the Gemini file handles of its parts) and ``analyzed`` (with its result),
+    and every transition is committed as it happens. A run that is given a journal
+    with the same ``run_id`` after a crash or a failed request serves the analyzed
+    images from it, reuses the uploads of the uploaded ones while they are still
+    recorded in the ``FileRegistry`` and more than ``expiry_margin`` seconds from
+    expiring, and only compresses, uploads and analyzes what is left.
+
+    Images are recorded by their ``objectdetection.cache_key``, which covers the
+    image content, the prompt, the model, the generation config and the
+    preprocessing settings, so a replaced file or a changed prompt, model or
+    compression starts over.
+    Once every image of a run is analyzed the run calls ``finish``, which forgets
+    its entries: the journal resumes interrupted runs, it does not cache results
+    (that is ``ResultCache``'s job). The database runs in WAL mode, so killing the
+    process at any point loses at most the transition in flight. Safe to use from
+    several threads.
+
+    Args:
+        path (str): SQLite database file
+        run_id (str, optional): Run or job the entries belong to. Give every job its
+            own id and pass the same id again to resume it.
+        expiry_margin (float, optional): Seconds before expiry from which a recorded
+            upload is no longer reused
+    """
+
+    def __init__(self, path="analysis_jobs.sqlite3", run_id="default", expiry_margin=3600):
+        self.path = path
+        self.run_id = run_id
+        self.expiry_margin = expiry_margin
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS run_images ("
+                "run_id TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, compressed_bytes INTEGER, "
+                "files TEXT, result TEXT, updated_at REAL NOT NULL, PRIMARY KEY (run_id, key))"
+            )
+
+    def _record(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT state, files, result FROM run_images WHERE run_id = ? AND key = ?", (self.run_id, key)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"state": row[0], "files": json.loads(row[1]) if row[1] else None,
+                "result": json.loads(row[2]) if row[2] else None}
+
+    def _update(self, key, state, **columns):
+        names = ["run_id", "key", "state", "updated_at", *columns]
+        values = [self.run_id, key, state, time.time(), *columns.values()]
+        # Keep the columns of earlier states (the upload of an analyzed image stays recorded)
+        updates = ", ".join(f"{name} = excluded.{name}" for name in names[2:])
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT INTO run_images ({', '.join(names)}) VALUES ({', '.join('?' * len(names))}) "
+                f"ON CONFLICT (run_id, key) DO UPDATE SET {updates}",
+                values,
+            )
+
+    def result(self, key):
+        """
+        Recorded result of an analyzed image.
+
+        Args:
+            key (str): ``objectdetection.cache_key`` of the image
+
+        Returns:
+            dict or None: The result, or None if the image was not analyzed in this run
+        """
+        record = self._record(key)
+        return record["result"] if record is not None and record["state"] == ANALYZED else None
+
+    def uploaded_parts(self, key, registry=None):
+        """
+        Recorded uploads of an image, if they can still be used.
+
+        Args:
+            key (str): ``objectdetection.cache_key`` of the image
+            registry (FileRegistry, optional): Only reuse files this registry still
+                holds, so files deleted by ``FileJanitor`` or gone remotely are
+                uploaded again
+
+        Returns:
+            list or None: ``(part_id, file_types.File)`` pairs, or None if the image has
+            to be compressed and sent again
+        """
+        record = self._record(key)
+        if record is None or not record["files"]:
+            return None
+        if any(entry["expires_at"] - self.expiry_margin <= time.time() for entry in record["files"]):
+            return None
+        if registry is not None and not all(registry.touch(entry["name"]) for entry in record["files"]):
+            return None
+        return [
+            (entry["part_id"], file_types.File(protos.File(
+                name=entry["name"],
+                uri=entry["uri"],
+                mime_type=entry["mime_type"],
+                expiration_time=datetime.datetime.fromtimestamp(entry["expires_at"], datetime.timezone.utc),
+                state=protos.File.State.ACTIVE,
+            )))
+            for entry in record["files"]
+        ]
+
+    def mark_compressed(self, key, compressed_bytes):
+        """Record that an image was compressed to ``compressed_bytes`` bytes."""
+        self._update(key, COMPRESSED, compressed_bytes=compressed_bytes, files=None, result=None)
+
+    def mark_uploaded(self, key, parts):
+        """
+        Record the uploaded parts of an image.
+
+        Args:
+            key (str): ``objectdetection.cache_key`` of the image
+            parts (list): ``(part_id, file_types.File)`` pairs, one per part of the image
+        """
+        now = time.time()
+        files = [
+            {
+                "part_id": part_id,
+                "name": file.name,
+                "uri": file.uri,
+                "mime_type": file.mime_type,
+                "expires_at": file.expiration_time.timestamp() if file.expiration_time else now + 48 * 3600,
+            }
+            for part_id, file in parts
+        ]
+        self._update(key, UPLOADED, files=json.dumps(files), result=None)
+
+    def mark_analyzed(self, key, result):
+        """Record the analysis result of an image."""
+        self._update(key, ANALYZED, result=json.dumps(result))
+
+    def counts(self):
+        """
+        Number of recorded images of this run per state.
+
+        Returns:
+            dict: ``{state: count}``
+        """
+        with self._lock:
+            return dict(self._conn.execute(
+                "SELECT state, COUNT(*) FROM run_images WHERE run_id = ? GROUP BY state", (self.run_id,)
+            ).fetchall())
+
+    def finish(self):
+        """Forget the entries of this run once all its images are analyzed."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM run_images WHERE run_id = ?", (self.run_id,))
+
+    def clear(self):
+        """Forget the entries of every run, so the next run starts from scratch."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM run_images")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,292 @@
+import time
+import uuid
+import logging
+import threading
+import collections
+
+from objectdetection import PREPROCESS_WORKERS, analyze_image_paths, make_preprocess_executor
+
+logger = logging.getLogger(__name__)
+
+# Job states: queued, then running, then done or failed. Queued jobs can be cancelled.
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class AnalysisJob:
+    """
+    One submitted analysis and everything known about it so far.
+
+    The images are dropped once the job is finished, so the memory of uploaded
+    ``ImageBuffer``s is released while the job's results are still kept.
+
+    Args:
+        image_paths (list): Images to analyze, paths or ``objectdetection.ImageBuffer``s
+        owner (str): Session or user the job was submitted by
+        options (dict): Passed on to ``objectdetection.analyze_image_paths``
+    """
+
+    def __init__(self, image_paths, owner, options):
+        self.id = uuid.uuid4().hex
+        self.image_paths = list(image_paths)
+        self.owner = owner
+        self.options = options
+        self.state = QUEUED
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.counts = {"total": len(self.image_paths), "compressed": 0, "uploaded": 0, "analyzed": 0}
+        self.results = {}
+        self.error = None
+
+    def finish(self, state):
+        """Move to a finished state and let go of the images."""
+        self.state = state
+        self.finished_at = time.time()
+        self.image_paths = []
+
+
+class JobRunner:
+    """
+    Local runner of analysis jobs shared by every session of a process.
+
+    Jobs are submitted with ``submit`` and run in the background by ``workers``
+    threads, so submitting returns at once and a job keeps running when the
+    page that submitted it is closed or reloaded. Callers poll ``status`` with
+    the job id: the state (queued, running, done, failed or cancelled), the
+    counts of compressed, uploaded and analyzed images and the verdicts so far.
+
+    Every owner (a session, a user) has its own queue and the queues are served
+    round robin, so one owner submitting many jobs does not hold up the others.
+    All jobs share one pool of ``preprocess_workers`` compression processes and
+    each uses at most ``upload_workers`` upload threads, which bounds the work in
+    flight no matter how many sessions submit at once. Finished jobs are kept
+    for ``retention`` seconds.
+
+    Args:
+        workers (int): Jobs analyzed at once
+        preprocess_workers (int): Processes of the shared compression pool. 0
+            compresses in the upload threads instead.
+        upload_workers (int): Upload threads per job
+        retention (float): Seconds a finished job stays available
+        **analyze_options: Defaults for ``objectdetection.analyze_image_paths``
+            (``cache``, ``journal``, ``upload_mode``, ...), overridable per job
+    """
+
+    def __init__(self, workers=1, preprocess_workers=PREPROCESS_WORKERS, upload_workers=16, retention=3600,
+                 **analyze_options):
+        self.workers = workers
+        self.preprocess_workers = preprocess_workers
+        self.retention = retention
+        self.analyze_options = dict(analyze_options, preprocess_workers=preprocess_workers,
+                                    upload_workers=upload_workers)
+
+        self._jobs = {}
+        # Queued job ids per owner, owners in serving order
+        self._queues = collections.OrderedDict()
+        self._condition = threading.Condition()
+        self._stop_event = threading.Event()
+        self._threads = []
+        self._preprocess_executor = None
+
+    def submit(self, image_paths, owner=None, **options):
+        """
+        Queue the analysis of a list of images.
+
+        Args:
+            image_paths (list): Images to analyze, paths or ``objectdetection.ImageBuffer``s
+            owner (str, optional): Session or user submitting the job, for fair scheduling
+            **options: Passed on to ``objectdetection.analyze_image_paths``
+
+        Returns:
+            str: Id of the job
+        """
+        job = AnalysisJob(image_paths, owner, dict(self.analyze_options, **options))
+        with self._condition:
+            self._prune()
+            self._jobs[job.id] = job
+            self._queues.setdefault(owner, collections.deque()).append(job.id)
+            self._condition.notify()
+        logger.info(f"Queued job {job.id} of {len(job.image_paths)} images for {owner}")
+        return job.id
+
+    def _snapshot(self, job):
+        status = {
+            "id": job.id,
+            "owner": job.owner,
+            "state": job.state,
+            "submitted_at": job.submitted_at,
+            "started_at": job.started_at,
+            "finished_at": job.finished_at,
+            "results": dict(job.results),
+            "error": job.error,
+            **job.counts,
+        }
+        if job.state == QUEUED:
+            status["position"] = self._queue_order().index(job.id)
+        return status
+
+    def _queue_order(self):
+        # Queued job ids in the order _next_job will start them
+        queues = [collections.deque(queue) for queue in self._queues.values()]
+        order = []
+        while queues:
+            queue = queues.pop(0)
+            order.append(queue.popleft())
+            if queue:
+                queues.append(queue)
+        return order
+
+    def status(self, job_id):
+        """
+        Current state of a job.
+
+        Returns:
+            dict or None: ``{"id", "owner", "state", "submitted_at", "started_at",
+            "finished_at", "total", "compressed", "uploaded", "analyzed", "results",
+            "error"}``, plus ``position`` (queued jobs that start before it) while queued, or
+            None for an unknown or expired job
+        """
+        with self._condition:
+            job = self._jobs.get(job_id)
+            return self._snapshot(job) if job is not None else None
+
+    def jobs(self, owner=None):
+        """
+        States of all known jobs, or of the jobs of one owner, oldest first.
+
+        Returns:
+            list: ``status`` dicts
+        """
+        with self._condition:
+            return [
+                self._snapshot(job) for job in sorted(self._jobs.values(), key=lambda job: job.submitted_at)
+                if owner is None or job.owner == owner
+            ]
+
+    def wait(self, job_id, timeout=None):
+        """
+        Wait until a job is finished.
+
+        Returns:
+            dict or None: The job's ``status``, which is still queued or running if
+            ``timeout`` expired first
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._condition:
+            while job_id in self._jobs and self._jobs[job_id].state not in FINISHED:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            job = self._jobs.get(job_id)
+            return self._snapshot(job) if job is not None else None
+
+    def cancel(self, job_id):
+        """
+        Cancel a queued job. Running jobs are not interrupted.
+
+        Returns:
+            bool: Whether the job was cancelled
+        """
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None or job.state != QUEUED:
+                return False
+            self._queues[job.owner].remove(job_id)
+            if not self._queues[job.owner]:
+                del self._queues[job.owner]
+            job.finish(CANCELLED)
+            self._condition.notify_all()
+        return True
+
+    def _prune(self):
+        # Forget finished jobs after their retention period
+        now = time.time()
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.state in FINISHED and now - job.finished_at > self.retention]:
+            del self._jobs[job_id]
+
+    def _next_job(self):
+        # Round robin over owners: take the oldest job of the first owner and move
+        # that owner to the back if it has more queued
+        owner, queue = next(iter(self._queues.items()))
+        job = self._jobs[queue.popleft()]
+        del self._queues[owner]
+        if queue:
+            self._queues[owner] = queue
+        return job
+
+    def _run_job(self, job):
+        def on_progress(event):
+            with self._condition:
+                job.counts.update({name: event[name] for name in ("compressed", "uploaded", "analyzed")})
+                if event["stage"] == "analyzed":
+                    job.results[event["image_id"]] = event["result"]
+
+        start = time.perf_counter()
+        try:
+            results = analyze_image_paths(
+                job.image_paths, preprocess_executor=self._preprocess_executor, on_progress=on_progress,
+                **job.options
+            )
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {e}")
+            with self._condition:
+                job.error = str(e)
+                job.finish(FAILED)
+                self._condition.notify_all()
+            return
+
+        with self._condition:
+            job.results = results
+            job.finish(DONE)
+            self._condition.notify_all()
+        logger.info(f"Job {job.id} done: {len(results)} of {job.counts['total']} images analyzed "
+                    f"in {time.perf_counter() - start:.1f}s")
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._queues and not self._stop_event.is_set():
+                    self._condition.wait()
+                if self._stop_event.is_set():
+                    return
+                job = self._next_job()
+                job.state = RUNNING
+                job.started_at = time.time()
+            self._run_job(job)
+
+    def start(self):
+        """Start the worker threads and the shared compression pool."""
+        self._stop_event.clear()
+        if self.preprocess_workers:
+            self._preprocess_executor = make_preprocess_executor(self.preprocess_workers)
+        self._threads = [
+            threading.Thread(target=self._work, name=f"job-runner-{i}", daemon=True) for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """Stop after the running jobs; queued jobs stay queued."""
+        with self._condition:
+            self._stop_event.set()
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self._preprocess_executor is not None:
+            self._preprocess_executor.shutdown()
+            self._preprocess_executor = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
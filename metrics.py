@@ -0,0 +1,325 @@
+import io
+import json
+import time
+import pstats
+import bisect
+import logging
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the stage latency histograms
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class Histogram:
+    """
+    Cumulative histogram of observed values with fixed bucket bounds.
+
+    Args:
+        buckets (tuple): Increasing upper bounds; values above the last one are only
+            counted in ``count`` (the +Inf bucket)
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimate a quantile from the buckets, interpolating linearly inside a bucket.
+
+        Args:
+            q (float): Quantile between 0 and 1
+
+        Returns:
+            float: The estimate, or None without observations
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            if count and seen + count >= rank:
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return self.buckets[-1]
+
+    def snapshot(self):
+        cumulative = []
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": dict(zip([str(bound) for bound in self.buckets], cumulative)),
+        }
+
+
+class Metrics:
+    """
+    Per-stage latency histograms and counters of the analysis pipeline.
+
+    Stages are timed with ``timer`` (or ``observe`` for durations measured
+    elsewhere); counters track bytes, tokens, retries and errors. Exporters read
+    ``snapshot``. Safe to use from several threads.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.started_at = time.time()
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        """Record one duration of ``stage``."""
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """
+        Time a block as one observation of ``stage``; errors are counted under
+        ``<stage>_errors`` and re-raised.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc(f"{stage}_errors")
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def inc(self, counter, amount=1):
+        """Add ``amount`` to ``counter``."""
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + amount
+
+    def snapshot(self):
+        """
+        Current state of all stages and counters.
+
+        Returns:
+            dict: ``{"timestamp", "uptime", "stages": {stage: histogram}, "counters": {name: value}}``
+        """
+        with self._lock:
+            return {
+                "timestamp": time.time(),
+                "uptime": time.time() - self.started_at,
+                "stages": {stage: histogram.snapshot() for stage, histogram in self._histograms.items()},
+                "counters": dict(self._counters),
+            }
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self._histograms = {}
+            self._counters = {}
+
+    def summary(self):
+        """One line per stage with count, mean, p50 and p99, for logs."""
+        lines = []
+        for stage, data in sorted(self.snapshot()["stages"].items()):
+            mean = data["sum"] / data["count"] if data["count"] else 0.0
+            lines.append(
+                f"{stage}: {data['count']} x, mean {mean * 1000:.1f} ms, "
+                f"p50 {data['p50'] * 1000:.1f} ms, p99 {data['p99'] * 1000:.1f} ms"
+            )
+        return lines
+
+
+def prometheus_text(metrics, namespace="genai"):
+    """
+    Render a metrics snapshot in the Prometheus text exposition format.
+
+    Args:
+        metrics (Metrics): Metrics to render
+        namespace (str): Prefix of the metric names
+
+    Returns:
+        str: ``<namespace>_stage_seconds`` histograms labelled by stage and one
+        ``<namespace>_<counter>_total`` counter per counter
+    """
+    snapshot = metrics.snapshot()
+    lines = [
+        f"# HELP {namespace}_stage_seconds Latency of a pipeline stage.",
+        f"# TYPE {namespace}_stage_seconds histogram",
+    ]
+    for stage, data in sorted(snapshot["stages"].items()):
+        for bound, count in data["buckets"].items():
+            lines.append(f'{namespace}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+        lines.append(f'{namespace}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {data["count"]}')
+        lines.append(f'{namespace}_stage_seconds_sum{{stage="{stage}"}} {data["sum"]}')
+        lines.append(f'{namespace}_stage_seconds_count{{stage="{stage}"}} {data["count"]}')
+    for counter, value in sorted(snapshot["counters"].items()):
+        lines.append(f"# TYPE {namespace}_{counter}_total counter")
+        lines.append(f"{namespace}_{counter}_total {value}")
+    return "\n".join(lines) + "\n"
+
+
+class PrometheusExporter:
+    """
+    Serve ``prometheus_text`` of a ``Metrics`` at ``http://host:port/metrics``.
+
+    Args:
+        metrics (Metrics): Metrics to serve
+        host (str): Interface to bind
+        port (int): Port to bind, 0 picks a free port
+    """
+
+    def __init__(self, metrics, host="0.0.0.0", port=9464):
+        self.metrics = metrics
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logger.debug("%s - %s", self.address_string(), format % args)
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                data = prometheus_text(exporter.metrics).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f"Serving metrics on port {self.port}")
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class JsonLinesExporter:
+    """
+    Append a ``Metrics`` snapshot as one JSON line every ``interval`` seconds.
+
+    A last snapshot is written on ``stop``, so short runs still leave a record.
+
+    Args:
+        metrics (Metrics): Metrics to write
+        path (str): JSON lines file to append to
+        interval (float): Seconds between two snapshots
+    """
+
+    def __init__(self, metrics, path="metrics.jsonl", interval=10.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def write(self):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(self.metrics.snapshot()) + "\n")
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.write()
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+@contextlib.contextmanager
+def profile_run(profile_path=None, top=20, trace_memory=True):
+    """
+    Profile a single run with cProfile and tracemalloc.
+
+    cProfile only sees the thread that enters the block; the worker threads of the
+    pipeline show up as time spent waiting on them, so use it for the calling
+    thread's share and the stage histograms for the rest. tracemalloc covers all
+    threads.
+
+    Args:
+        profile_path (str, optional): Write the raw profile here (open it with
+            ``python -m pstats`` or snakeviz)
+        top (int): Functions and allocation sites to log
+        trace_memory (bool): Also trace allocations with tracemalloc
+    """
+    profiler = cProfile.Profile()
+    tracing = trace_memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if profile_path:
+            profiler.dump_stats(profile_path)
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(top)
+        logger.info(f"Profile of the run:\n{report.getvalue()}")
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            allocations = tracemalloc.take_snapshot().statistics("lineno")[:top]
+            tracemalloc.stop()
+            logger.info(
+                f"Memory: {current / 1e6:.1f} MB traced at the end, {peak / 1e6:.1f} MB peak. Top allocation sites:\n"
+                + "\n".join(str(stat) for stat in allocations)
+            )
+
+
+# Metrics of this process, shared by all pipeline stages
+METRICS = Metrics()
@@ -0,0 +1,149 @@
+import cv2
+import numpy as np
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class PersonPrefilter:
+    """
+    Local CPU check for people in an image, run before anything is sent to Gemini.
+
+    Uses OpenCV's default HOG + linear SVM pedestrian detector. An image without a
+    detected person cannot show phone usage, so it is answered "no" locally and only
+    the candidates go to Gemini. The detector is tuned for recall: ``hit_threshold``
+    and ``min_weight`` default low so that doubtful images are still sent rather than
+    skipped. HOG is weakest on people that are small, seated or partly occluded; raise
+    ``max_side`` (more pixels, slower) or lower ``min_weight`` if it misses them on
+    your cameras. Safe to share between threads.
+
+    Args:
+        max_side (int): Images are scaled down to this many pixels on their longest side
+            before detection
+        win_stride (tuple): Step of the detection window in pixels
+        scale (float): Scale step between pyramid levels
+        hit_threshold (float): SVM distance threshold of a single window
+        min_weight (float): Minimum detection weight for an image to count as a candidate
+        skip_confidence (float): Confidence reported with the local "no" verdicts
+    """
+
+    def __init__(self, max_side=800, win_stride=(8, 8), scale=1.05, hit_threshold=0.0, min_weight=0.3,
+                 skip_confidence=0.8):
+        self.max_side = max_side
+        self.win_stride = win_stride
+        self.scale = scale
+        self.hit_threshold = hit_threshold
+        self.min_weight = min_weight
+        self.skip_confidence = skip_confidence
+        self.checked = 0
+        self.skipped = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _detector(self):
+        # HOGDescriptor instances are not shared between threads
+        hog = getattr(self._local, "hog", None)
+        if hog is None:
+            hog = cv2.HOGDescriptor()
+            hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+            self._local.hog = hog
+        return hog
+
+    def detect(self, image):
+        """
+        Detect people in an image.
+
+        Args:
+            image (numpy.ndarray): BGR or grayscale image
+
+        Returns:
+            list: ``(x, y, w, h, weight)`` tuples in the coordinates of ``image``
+        """
+        height, width = image.shape[:2]
+        factor = min(1.0, self.max_side / max(height, width))
+        small = image
+        if factor < 1.0:
+            small = cv2.resize(image, (round(width * factor), round(height * factor)), interpolation=cv2.INTER_AREA)
+
+        boxes, weights = self._detector().detectMultiScale(
+            small, hitThreshold=self.hit_threshold, winStride=self.win_stride, scale=self.scale
+        )
+        return [
+            (*(int(round(v / factor)) for v in box), float(weight))
+            for box, weight in zip(boxes, weights.ravel() if len(weights) else [])
+        ]
+
+    def has_person(self, image):
+        """
+        Decide whether an image should be sent to Gemini and record the decision.
+
+        Args:
+            image (numpy.ndarray): BGR or grayscale image
+
+        Returns:
+            bool: True if a person was detected, False if the image can be skipped
+        """
+        found = any(weight >= self.min_weight for *_, weight in self.detect(image))
+        with self._lock:
+            self.checked += 1
+            if not found:
+                self.skipped += 1
+        return found
+
+    def check_path(self, image_path):
+        """
+        ``has_person`` for an image file.
+
+        Images OpenCV cannot read are treated as candidates, so Gemini still sees them.
+
+        Args:
+            image_path (str): Path to the image
+
+        Returns:
+            bool: True if the image should be sent to Gemini
+        """
+        image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+        if image is None:
+            logger.warning(f"Pre-filter could not read {image_path}, sending it to Gemini")
+            return True
+        return self.has_person(image)
+
+    def check_bytes(self, data):
+        """
+        ``has_person`` for an encoded image held in memory, see ``check_path``.
+
+        Args:
+            data (bytes or memoryview): Encoded image
+
+        Returns:
+            bool: True if the image should be sent to Gemini
+        """
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            logger.warning("Pre-filter could not decode an image, sending it to Gemini")
+            return True
+        return self.has_person(image)
+
+    def skip_result(self):
+        """Analysis result recorded for an image skipped by the pre-filter."""
+        return {
+            "answer": "no",
+            "confidence": self.skip_confidence,
+            "explanation": "No person detected by the local pre-filter, so no phone usage.",
+        }
+
+    @property
+    def skip_ratio(self):
+        """Fraction of checked images that were answered locally."""
+        return self.skipped / self.checked if self.checked else 0.0
+
+    def stats(self):
+        """
+        Pre-filter counts since the filter was created.
+
+        Returns:
+            dict: ``{"checked": int, "skipped": int, "skip_ratio": float}``
+        """
+        with self._lock:
+            return {"checked": self.checked, "skipped": self.skipped, "skip_ratio": self.skip_ratio}
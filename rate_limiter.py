@@ -0,0 +1,538 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+import collections
+import concurrent.futures
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# HTTP statuses worth retrying: throttling, timeouts and transient server errors
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+THROTTLE_STATUSES = {429, 503}
+# Errors without a status worth retrying: dropped connections and timeouts, including
+# those of ``requests``, which the SDK uses with transport="rest", and of
+# ``asyncio.wait_for``, which is not a TimeoutError before Python 3.11
+TRANSIENT_ERRORS = (ConnectionError, TimeoutError, asyncio.TimeoutError, requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout)
+
+
+def error_status(error):
+    """
+    HTTP status of an API error, if it has one.
+
+    Handles ``google.api_core`` exceptions (``code``) and ``googleapiclient`` errors
+    used by file uploads (``resp.status``).
+
+    Args:
+        error (Exception): Error raised by an API call
+
+    Returns:
+        int or None: The HTTP status code
+    """
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code
+    resp = getattr(error, "resp", None)
+    status = getattr(resp, "status", None)
+    return int(status) if status is not None else None
+
+
+def retry_after(error):
+    """
+    Server-provided retry delay of an API error, if any.
+
+    Looks at ``Retry-After`` headers and at gRPC ``RetryInfo`` details.
+
+    Args:
+        error (Exception): Error raised by an API call
+
+    Returns:
+        float or None: Seconds the server asked us to wait
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None) or getattr(error, "resp", None)
+    if headers is not None:
+        value = headers.get("Retry-After") or headers.get("retry-after")
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            pass
+
+    for detail in getattr(error, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+    return None
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at ``per_minute`` tokens per minute.
+
+    Args:
+        per_minute (float): Sustained rate
+        burst_seconds (float): Capacity of the bucket, in seconds worth of tokens
+    """
+
+    def __init__(self, per_minute, burst_seconds=5.0):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, amount=1.0):
+        """
+        Take ``amount`` tokens if they are available.
+
+        Returns:
+            float: 0 if the tokens were taken, otherwise the seconds until they will be
+        """
+        # A request larger than the bucket would never fit, so it takes a full bucket
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill()
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0.0
+            return (amount - self._tokens) / self.rate
+
+    def acquire(self, amount=1.0):
+        """
+        Take ``amount`` tokens, waiting until they are available.
+
+        Returns:
+            float: Seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            wait = self.try_acquire(amount)
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    async def acquire_async(self, amount=1.0):
+        """Like ``acquire``, but waits without blocking the event loop."""
+        waited = 0.0
+        while True:
+            wait = self.try_acquire(amount)
+            if not wait:
+                return waited
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def adjust(self, amount):
+        """Return (positive) or charge (negative) tokens after the real usage is known."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+
+def _resolve(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class AdaptiveConcurrency:
+    """
+    Concurrency limit adjusted with additive increase / multiplicative decrease.
+
+    Every successful call raises the limit by ``1 / limit`` (about one slot per
+    round of calls); a throttled call halves it. Decreases are rate limited to one
+    per ``cooldown`` seconds so a burst of 429s from the same round only counts once.
+
+    Args:
+        initial (int): Starting limit
+        minimum (int): Lowest limit
+        maximum (int): Highest limit
+        decrease_factor (float): Factor applied on throttling
+        cooldown (float): Minimum seconds between two decreases
+    """
+
+    def __init__(self, initial=16, minimum=1, maximum=150, decrease_factor=0.5, cooldown=1.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        # (loop, future) of the coroutines waiting in ``acquire_async``, oldest first
+        self._async_waiters = collections.deque()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def try_acquire(self):
+        with self._condition:
+            if self._in_flight >= int(self._limit):
+                return False
+            self._in_flight += 1
+            return True
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    async def acquire_async(self):
+        """Like ``acquire``, but waits on a future of the running loop instead of blocking it."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self._in_flight < int(self._limit):
+                    self._in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self._condition:
+                    try:
+                        self._async_waiters.remove((loop, waiter))
+                    except ValueError:
+                        # Woken but cancelled before it could take the slot: pass the wake-up on
+                        self._wake()
+                raise
+
+    def _wake(self):
+        # Called with the condition held. Wakes one waiting thread and one waiting
+        # coroutine; whichever loses the race for the slot waits again.
+        self._condition.notify()
+        while self._async_waiters:
+            loop, waiter = self._async_waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(_resolve, waiter)
+                return
+            except RuntimeError:
+                # The waiter's loop was closed
+                continue
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._wake()
+
+    def on_success(self):
+        with self._condition:
+            self._limit = min(self.maximum, self._limit + 1.0 / self._limit)
+            self._wake()
+
+    def on_throttle(self):
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self._limit = max(self.minimum, self._limit * self.decrease_factor)
+            logger.warning(f"Throttled by the API, concurrency limit lowered to {int(self._limit)}")
+
+
+class RateLimiter:
+    """
+    Shared gate for Gemini API calls.
+
+    Every call waits for a request token (requests per minute), for its estimated
+    input tokens (tokens per minute) and for a slot under the adaptive concurrency
+    limit. Throttled and transient failures are retried with exponential backoff
+    and full jitter, honouring the server's retry-after hint when it sends one.
+
+    Args:
+        requests_per_minute (float): Request quota
+        tokens_per_minute (float): Input token quota
+        initial_concurrency (int): Starting number of calls in flight
+        max_concurrency (int): Highest number of calls in flight
+        max_attempts (int): Attempts per call, including the first
+        backoff_base (float): Delay before the first retry in seconds
+        backoff_max (float): Maximum delay between attempts in seconds
+        metrics (Metrics, optional): Records the time spent waiting for quota
+            ("rate_limit_wait") and between retries ("retry_wait"), and counts
+            retries and throttled calls
+    """
+
+    def __init__(self, requests_per_minute=2000, tokens_per_minute=4000000, initial_concurrency=16,
+                 max_concurrency=150, max_attempts=5, backoff_base=1.0, backoff_max=60.0, metrics=None):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.concurrency = AdaptiveConcurrency(initial_concurrency, maximum=max_concurrency)
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.metrics = metrics
+
+    def _record_failure(self, status, delay):
+        if self.metrics is None:
+            return
+        if status in THROTTLE_STATUSES:
+            self.metrics.inc("throttled")
+        if delay is not None:
+            self.metrics.inc("retries")
+            self.metrics.observe("retry_wait", delay)
+
+    def backoff(self, attempt, error=None):
+        """
+        Delay before retry number ``attempt`` (1 for the first retry).
+
+        Returns:
+            float: Seconds to wait
+        """
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1))))
+        hint = retry_after(error) if error is not None else None
+        if hint is not None:
+            # Never retry before the server allows it, but keep some jitter on top
+            delay = max(delay, hint + random.uniform(0, self.backoff_base))
+        return delay
+
+    def call(self, fn, *args, estimated_tokens=0, deadline=None, **kwargs):
+        """
+        Run ``fn(*args, **kwargs)`` under the rate and concurrency limits, with retries.
+
+        Args:
+            fn (callable): API call to make
+            estimated_tokens (int, optional): Input tokens the call is expected to use
+            deadline (float, optional): ``time.monotonic()`` after which no retry is
+                started
+
+        Returns:
+            The result of ``fn``. The last error is raised once all attempts failed,
+            immediately when it is not retryable and when the next attempt would
+            start after ``deadline``.
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            start = time.perf_counter()
+            self.requests.acquire(1)
+            if estimated_tokens:
+                self.tokens.acquire(estimated_tokens)
+            self.concurrency.acquire()
+            if self.metrics is not None:
+                self.metrics.observe("rate_limit_wait", time.perf_counter() - start)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                status = error_status(e)
+                if status in THROTTLE_STATUSES:
+                    self.concurrency.on_throttle()
+                retryable = status in RETRYABLE_STATUSES or isinstance(e, TRANSIENT_ERRORS)
+                if not retryable or attempt == self.max_attempts:
+                    self._record_failure(status, None)
+                    raise
+                delay = self.backoff(attempt, e)
+                if deadline is not None and time.monotonic() + delay >= deadline:
+                    self._record_failure(status, None)
+                    raise
+                self._record_failure(status, delay)
+                logger.warning(f"API call failed with status {status}, retrying in {delay:.1f}s: {e}")
+            else:
+                self.concurrency.on_success()
+                return result
+            finally:
+                self.concurrency.release()
+            time.sleep(delay)
+
+    async def call_async(self, fn, *args, estimated_tokens=0, deadline=None, **kwargs):
+        """
+        Await ``fn(*args, **kwargs)`` under the same limits and retry policy as ``call``.
+
+        Args:
+            fn (callable): Coroutine function making the API call
+            estimated_tokens (int, optional): Input tokens the call is expected to use
+            deadline (float, optional): ``time.monotonic()`` after which no retry is
+                started
+
+        Returns:
+            The result of ``fn``
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            start = time.perf_counter()
+            await self.requests.acquire_async(1)
+            if estimated_tokens:
+                await self.tokens.acquire_async(estimated_tokens)
+            await self.concurrency.acquire_async()
+            if self.metrics is not None:
+                self.metrics.observe("rate_limit_wait", time.perf_counter() - start)
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                status = error_status(e)
+                if status in THROTTLE_STATUSES:
+                    self.concurrency.on_throttle()
+                retryable = status in RETRYABLE_STATUSES or isinstance(e, TRANSIENT_ERRORS)
+                if not retryable or attempt == self.max_attempts:
+                    self._record_failure(status, None)
+                    raise
+                delay = self.backoff(attempt, e)
+                if deadline is not None and time.monotonic() + delay >= deadline:
+                    self._record_failure(status, None)
+                    raise
+                self._record_failure(status, delay)
+                logger.warning(f"API call failed with status {status}, retrying in {delay:.1f}s: {e}")
+            else:
+                self.concurrency.on_success()
+                return result
+            finally:
+                self.concurrency.release()
+            await asyncio.sleep(delay)
+
+
+class HedgePolicy:
+    """
+    Hedging of slow calls: a call still running after most calls would have
+    finished gets a duplicate, and whichever answer arrives first is used.
+
+    The delay before hedging is the ``quantile`` of the durations of the last
+    ``window`` calls, and at least ``min_delay`` seconds; nothing is hedged until
+    ``min_samples`` calls finished. Duplicates cost quota and tokens, so at most
+    ``max_ratio`` of all calls are hedged. A hedge only pays off for the tail:
+    at the 0.95 quantile about one call in twenty is slow enough to be hedged.
+
+    Args:
+        quantile (float): Quantile of recent call durations after which a call is hedged
+        max_ratio (float): Highest share of calls that get a duplicate
+        min_delay (float): Shortest delay before hedging in seconds
+        min_samples (int): Finished calls needed before hedging starts
+        window (int): Number of recent call durations the quantile is taken over
+        metrics (Metrics, optional): Counts "hedges" sent and "hedge_wins", the
+            hedges that answered first
+    """
+
+    def __init__(self, quantile=0.95, max_ratio=0.05, min_delay=1.0, min_samples=20, window=200, metrics=None):
+        self.quantile = quantile
+        self.max_ratio = max_ratio
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.metrics = metrics
+        self._durations = collections.deque(maxlen=window)
+        self._calls = 0
+        self._hedges = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        """Record the duration of a finished call."""
+        with self._lock:
+            self._durations.append(seconds)
+
+    def delay(self):
+        """
+        Count a new call and tell when it should be hedged.
+
+        Returns:
+            float or None: Seconds after which to hedge the call, or None while too
+            few calls have finished
+        """
+        with self._lock:
+            self._calls += 1
+            if len(self._durations) < self.min_samples:
+                return None
+            ordered = sorted(self._durations)
+        return max(self.min_delay, ordered[min(len(ordered) - 1, int(self.quantile * len(ordered)))])
+
+    def try_hedge(self):
+        """
+        Take a hedge from the budget.
+
+        Returns:
+            bool: Whether a duplicate may be sent
+        """
+        with self._lock:
+            if self._hedges + 1 > self.max_ratio * self._calls:
+                return False
+            self._hedges += 1
+        if self.metrics is not None:
+            self.metrics.inc("hedges")
+        return True
+
+    def _won(self, hedge, start):
+        self.observe(time.perf_counter() - start)
+        if hedge and self.metrics is not None:
+            self.metrics.inc("hedge_wins")
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Run ``fn(*args, **kwargs)``, hedged with a second concurrent run when it is slow.
+
+        ``fn`` must be safe to run twice at once. The slower run is not interrupted;
+        callers stop it themselves once ``call`` returns.
+
+        Returns:
+            The result of the first run that succeeds. When both fail, the error of
+            the last one to fail is raised.
+        """
+        start = time.perf_counter()
+        delay = self.delay()
+        if delay is None:
+            result = fn(*args, **kwargs)
+            self._won(False, start)
+            return result
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        try:
+            futures = [executor.submit(fn, *args, **kwargs)]
+            done, _ = concurrent.futures.wait(futures, timeout=delay)
+            if not done and self.try_hedge():
+                logger.info(f"Call still running after {delay:.1f}s, sending a hedged duplicate")
+                futures.append(executor.submit(fn, *args, **kwargs))
+            error = None
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                self._won(future is not futures[0], start)
+                return result
+            raise error
+        finally:
+            # Do not wait for the losing run
+            executor.shutdown(wait=False)
+
+    async def call_async(self, fn, *args, **kwargs):
+        """
+        Await ``fn(*args, **kwargs)``, hedged like ``call``. The slower run is cancelled.
+
+        Returns:
+            The result of the first run that succeeds
+        """
+        start = time.perf_counter()
+        delay = self.delay()
+        if delay is None:
+            result = await fn(*args, **kwargs)
+            self._won(False, start)
+            return result
+
+        tasks = [asyncio.ensure_future(fn(*args, **kwargs))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and self.try_hedge():
+                logger.info(f"Call still running after {delay:.1f}s, sending a hedged duplicate")
+                tasks.append(asyncio.ensure_future(fn(*args, **kwargs)))
+            error = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    self._won(task is not tasks[0], start)
+                    return task.result()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
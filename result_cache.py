@@ -0,0 +1,133 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class ResultCache:
+    """
+    Persistent cache of per-image analysis results in a local SQLite file.
+
+    Entries are keyed by a hash of the image content together with everything that
+    influences the verdict (prompt, model name, generation config and the settings
+    the image is compressed, cropped or tiled with), so changing
+    any of those never serves a stale answer. Entries older than ``ttl_seconds`` are
+    ignored and removed, and once the cache holds more than ``max_entries`` the least
+    recently used entries are evicted. Safe to use from several threads.
+
+    Args:
+        path (str): SQLite database file
+        max_entries (int, optional): Maximum number of cached results
+        ttl_seconds (float, optional): Maximum age of a cached result in seconds
+    """
+
+    def __init__(self, path="analysis_cache.sqlite3", max_entries=100000, ttl_seconds=30 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, result TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS results_accessed_at ON results (accessed_at)")
+
+    @staticmethod
+    def make_key(image_bytes, prompt, model_name, generation_config, preprocessing=None):
+        """
+        Build the cache key of an image analysis.
+
+        Args:
+            image_bytes (bytes): Content of the original image
+            prompt (str): Prompt sent with the image
+            model_name (str): Gemini model name
+            generation_config (dict): Generation config of the request
+            preprocessing (dict, optional): Settings that decide what the model is
+                shown of the image, such as its size, JPEG quality and crops
+
+        Returns:
+            str: Hex SHA-256 digest
+        """
+        digest = hashlib.sha256()
+        digest.update(hashlib.sha256(image_bytes).digest())
+        digest.update(prompt.encode("utf-8"))
+        digest.update(model_name.encode("utf-8"))
+        digest.update(json.dumps(generation_config, sort_keys=True).encode("utf-8"))
+        if preprocessing is not None:
+            digest.update(json.dumps(preprocessing, sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _expired(self, created_at, now):
+        return self.ttl_seconds is not None and now - created_at > self.ttl_seconds
+
+    def get(self, key):
+        """
+        Look up a cached result.
+
+        Args:
+            key (str): Key from ``make_key``
+
+        Returns:
+            dict or None: The cached result, or None on a miss
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT result, created_at FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None or self._expired(row[1], now):
+                self.misses += 1
+                return None
+            with self._conn:
+                self._conn.execute("UPDATE results SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, result):
+        """
+        Store a result. Call ``evict`` once a run has stored its results.
+
+        Args:
+            key (str): Key from ``make_key``
+            result (dict): Analysis result of the image
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, result, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(result), now, now),
+            )
+
+    def evict(self):
+        """
+        Remove expired entries and the least recently used entries over ``max_entries``.
+
+        Returns:
+            int: Number of removed entries
+        """
+        removed = 0
+        with self._lock, self._conn:
+            if self.ttl_seconds is not None:
+                removed += self._conn.execute(
+                    "DELETE FROM results WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+                ).rowcount
+            if self.max_entries is not None:
+                removed += self._conn.execute(
+                    "DELETE FROM results WHERE key IN ("
+                    "SELECT key FROM results ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                ).rowcount
+        return removed
+
+    @property
+    def hit_rate(self):
+        """Fraction of lookups served from the cache since it was opened."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,94 @@
+import cv2
+import threading
+import numpy as np
+
+
+def difference_hash(frame, hash_size=8):
+    """
+    Compute a difference hash (dHash) of a frame.
+
+    The frame is converted to grayscale and downscaled to ``hash_size + 1`` by
+    ``hash_size`` pixels; each bit records whether a pixel is brighter than its
+    right-hand neighbour. Small changes in noise or compression leave the hash
+    almost unchanged, while people moving through the scene flip many bits.
+
+    Args:
+        frame (numpy.ndarray): BGR or grayscale image
+        hash_size (int): Side length of the hash in bits
+
+    Returns:
+        numpy.ndarray: Boolean array of ``hash_size * hash_size`` bits
+    """
+    gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    return (small[:, 1:] > small[:, :-1]).flatten()
+
+
+class SceneChangeGate:
+    """
+    Drop frames that show (almost) the same scene as the last frame kept for a camera.
+
+    The gate keeps the hash of the last frame it let through per camera and only lets
+    a new frame through when its Hamming distance to that hash reaches ``threshold``.
+    Because the reference is only replaced on a kept frame, slow drift still
+    accumulates until it counts as a change. Safe to share between capture threads.
+
+    Args:
+        threshold (int): Minimum number of differing hash bits for a frame to be kept
+        hash_size (int): Side length of the hash in bits (``hash_size ** 2`` bits total)
+        max_skip (int, optional): Keep a frame anyway after this many consecutive
+            suppressions, so a static scene is still sampled occasionally
+    """
+
+    def __init__(self, threshold=6, hash_size=8, max_skip=None):
+        self.threshold = threshold
+        self.hash_size = hash_size
+        self.max_skip = max_skip
+        self._hashes = {}
+        self._skipped_in_row = {}
+        self._kept = {}
+        self._suppressed = {}
+        self._lock = threading.Lock()
+
+    def should_write(self, camera_id, frame):
+        """
+        Decide whether a frame differs enough from the camera's last kept frame.
+
+        Args:
+            camera_id (str): Camera the frame comes from
+            frame (numpy.ndarray): Decoded frame
+
+        Returns:
+            bool: True if the frame should be written, False if it is suppressed
+        """
+        frame_hash = difference_hash(frame, self.hash_size)
+
+        with self._lock:
+            previous = self._hashes.get(camera_id)
+            skipped = self._skipped_in_row.get(camera_id, 0)
+            changed = previous is None or np.count_nonzero(frame_hash != previous) >= self.threshold
+
+            if changed or (self.max_skip is not None and skipped >= self.max_skip):
+                self._hashes[camera_id] = frame_hash
+                self._skipped_in_row[camera_id] = 0
+                self._kept[camera_id] = self._kept.get(camera_id, 0) + 1
+                return True
+
+            self._skipped_in_row[camera_id] = skipped + 1
+            self._suppressed[camera_id] = self._suppressed.get(camera_id, 0) + 1
+            return False
+
+    def stats(self, camera_id=None):
+        """
+        Kept/suppressed counts for one camera or summed over all cameras.
+
+        Args:
+            camera_id (str, optional): Camera to report on. Defaults to all cameras.
+
+        Returns:
+            dict: ``{"kept": int, "suppressed": int}``
+        """
+        with self._lock:
+            if camera_id is not None:
+                return {"kept": self._kept.get(camera_id, 0), "suppressed": self._suppressed.get(camera_id, 0)}
+            return {"kept": sum(self._kept.values()), "suppressed": sum(self._suppressed.values())}
@@ -0,0 +1,275 @@
+import cv2
+import os
+import time
+import queue
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+from camera_supervisor import backoff_delay
+from downloadimages import FrameNamer, FrameSampler, RTSP_URLS, camera_id_from_url
+from objectdetection import ImageBuffer, compress_image_bytes, generate_analysis, make_image_parts
+
+logger = logging.getLogger(__name__)
+
+# A decoded frame travelling from a capture thread to an analysis worker
+CapturedFrame = namedtuple("CapturedFrame", ["name", "camera_id", "captured_at", "frame"])
+
+_STOP = object()
+
+
+class StreamingPipeline:
+    """
+    Stream frames from cameras straight to Gemini analysis without a disk round trip.
+
+    Capture threads sample frames (see ``downloadimages.FrameSampler``) and put the
+    decoded frames on a bounded queue. Analysis workers take micro-batches from the
+    queue, JPEG-encode each frame in memory, scale and compress it to the same size
+    and byte budget as images analyzed from disk (``objectdetection.compress_image_bytes``),
+    send the bytes (inline when small, see ``objectdetection.make_image_parts``) and
+    run the analysis. When analysis falls behind the queue fills up and ``put`` blocks the
+    capture threads, so memory stays bounded. Writing frames to disk is optional
+    and keeps the full resolution encode.
+
+    Verdicts go to ``on_result``; ``results`` only keeps the latest ``max_results`` of
+    them, so a pipeline running for days does not grow without bound.
+
+    Args:
+        rtsp_urls (list): Stream URLs or local video paths
+        on_result (callable, optional): Called as ``on_result(name, result)`` for every verdict
+        queue_size (int): Maximum number of decoded frames waiting for analysis
+        analysis_workers (int): Number of analysis threads
+        batch_size (int): Maximum frames per Gemini request
+        batch_timeout (float): Seconds to wait for a batch to fill before sending it
+        frame_interval (int): Keep one frame out of this many
+        sample_seconds (float, optional): Keep one frame every this many seconds instead
+        skip_decode (bool): Grab skipped frames without retrieving them
+        scene_gate (SceneChangeGate, optional): Drop frames without a scene change
+        prefilter (PersonPrefilter, optional): Answer frames without a detected person
+            locally instead of sending them to Gemini
+        save_directory (str, optional): Also write each analyzed frame here
+        jpeg_quality (int): JPEG quality of the full resolution encode the frame is
+            compressed from (and saved as)
+        drop_when_full (bool): Drop sampled frames instead of blocking capture when
+            the queue is full (keeps live streams from stalling)
+        max_results (int): Number of latest verdicts kept in ``results``
+    """
+
+    def __init__(self, rtsp_urls, on_result=None, queue_size=32, analysis_workers=2, batch_size=8,
+                 batch_timeout=2.0, frame_interval=125, sample_seconds=None, skip_decode=True,
+                 scene_gate=None, save_directory=None, jpeg_quality=90, drop_when_full=False, prefilter=None,
+                 max_results=1000):
+        self.rtsp_urls = list(rtsp_urls)
+        self.on_result = on_result
+        self.analysis_workers = analysis_workers
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.sampler_options = {
+            "frame_interval": frame_interval,
+            "sample_seconds": sample_seconds,
+            "skip_decode": skip_decode,
+        }
+        self.scene_gate = scene_gate
+        self.prefilter = prefilter
+        self.save_directory = save_directory
+        self.jpeg_quality = jpeg_quality
+        self.drop_when_full = drop_when_full
+
+        self.max_results = max_results
+        self.results = OrderedDict()
+        self.frames_captured = 0
+        self.frames_dropped = 0
+        self.frames_analyzed = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._capture_threads = []
+        self._analysis_threads = []
+
+    def _enqueue(self, item):
+        if self.drop_when_full:
+            try:
+                self._queue.put_nowait(item)
+                return True
+            except queue.Full:
+                return False
+
+        # Block while analysis catches up, but keep checking for shutdown
+        while not self._stop_event.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _capture(self, rtsp_url):
+        camera_id = camera_id_from_url(rtsp_url)
+        attempt = 0
+        namer = FrameNamer("", camera_id)
+        while not self._stop_event.is_set():
+            cap = cv2.VideoCapture(rtsp_url)
+            try:
+                if not cap.isOpened():
+                    logger.error(f"Could not open stream {rtsp_url}")
+                else:
+                    sampler = FrameSampler(**self.sampler_options)
+                    while not self._stop_event.is_set():
+                        ret, frame = sampler.next_frame(cap)
+                        if not ret:
+                            logger.warning(f"Could not read frame from {rtsp_url}, reconnecting")
+                            break
+                        attempt = 0
+                        if frame is None:
+                            continue
+                        if self.scene_gate is not None and not self.scene_gate.should_write(camera_id, frame):
+                            continue
+
+                        name = namer.next_path()
+                        item = CapturedFrame(name, camera_id, time.time(), frame)
+                        queued = self._enqueue(item)
+                        with self._lock:
+                            if queued:
+                                self.frames_captured += 1
+                            else:
+                                self.frames_dropped += 1
+            finally:
+                cap.release()
+
+            self._stop_event.wait(backoff_delay(attempt))
+            attempt += 1
+
+    def _next_batch(self):
+        """Collect up to ``batch_size`` frames, waiting at most ``batch_timeout`` after the first."""
+        item = self._queue.get()
+        if item is _STOP:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.batch_timeout
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                # Leave the sentinel for this worker's next call
+                self._queue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _encode(self, captured):
+        ok, buffer = cv2.imencode(".jpg", captured.frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        if not ok:
+            raise ValueError(f"Could not encode frame {captured.name}")
+        data = buffer.tobytes()
+        if self.save_directory is not None:
+            with open(os.path.join(self.save_directory, captured.name), "wb") as f:
+                f.write(data)
+        # The same scaling and byte budget as frames analyzed from the capture folder
+        data, _ = compress_image_bytes(ImageBuffer(captured.name, data))
+        return data
+
+    def _analyze_batch(self, batch):
+        frames = {captured.name: captured for captured in batch}
+
+        # Record each verdict as soon as it streams in, not when the whole batch is done
+        def record(name, result):
+            result = dict(result, latency=time.time() - frames[name].captured_at)
+            with self._lock:
+                self.results[name] = result
+                while len(self.results) > self.max_results:
+                    self.results.popitem(last=False)
+                self.frames_analyzed += 1
+            if self.on_result is not None:
+                self.on_result(name, result)
+
+        images = []
+        for captured in batch:
+            if self.prefilter is not None and not self.prefilter.has_person(captured.frame):
+                record(captured.name, self.prefilter.skip_result())
+                continue
+            try:
+                images.append((captured.name, self._encode(captured), "image/jpeg", captured.name))
+            except Exception as e:
+                logger.error(f"Error encoding frame {captured.name}: {e}")
+        uploaded = make_image_parts(images)
+
+        if not uploaded:
+            return
+
+        try:
+            generate_analysis(uploaded, record)
+        except Exception as e:
+            logger.error(f"Error during Gemini API call: {e}")
+
+    def _analysis_worker(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            self._analyze_batch(batch)
+
+    def start(self):
+        """Start the capture threads and analysis workers."""
+        if self.save_directory is not None:
+            os.makedirs(self.save_directory, exist_ok=True)
+        self._analysis_threads = [
+            threading.Thread(target=self._analysis_worker, daemon=True) for _ in range(self.analysis_workers)
+        ]
+        self._capture_threads = [
+            threading.Thread(target=self._capture, args=(rtsp_url,), daemon=True) for rtsp_url in self.rtsp_urls
+        ]
+        for thread in self._analysis_threads + self._capture_threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """Stop capturing, let the workers finish the queued frames and wait for them."""
+        self._stop_event.set()
+        for thread in self._capture_threads:
+            thread.join()
+        for _ in self._analysis_threads:
+            self._queue.put(_STOP)
+        for thread in self._analysis_threads:
+            thread.join()
+        logger.info(
+            f"Streaming pipeline stopped: {self.frames_captured} frames captured, "
+            f"{self.frames_analyzed} analyzed, {self.frames_dropped} dropped"
+        )
+        if self.prefilter is not None:
+            logger.info(f"Person pre-filter answered {self.prefilter.skip_ratio:.0%} of checked frames locally")
+
+    def run(self, duration_seconds=None):
+        """
+        Run the pipeline in the foreground.
+
+        Args:
+            duration_seconds (float, optional): Stop after this many seconds. Runs until
+                interrupted when omitted.
+
+        Returns:
+            dict: The latest ``max_results`` verdicts keyed by frame name
+        """
+        self.start()
+        try:
+            if duration_seconds is None:
+                while True:
+                    time.sleep(1)
+            else:
+                time.sleep(duration_seconds)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+        return self.results
+
+
+if __name__ == "__main__":
+    def print_result(name, data):
+        print(f"{name}: {data['answer']} - {data['explanation']}")
+
+    StreamingPipeline(RTSP_URLS, on_result=print_result, sample_seconds=5).run()